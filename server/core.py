@@ -1,7 +1,10 @@
 from __future__ import annotations
 
 import asyncio
+import os
 from contextlib import asynccontextmanager
+from datetime import timedelta
+from pathlib import Path
 from typing import TYPE_CHECKING, Optional, Self
 
 import orjson
@@ -10,9 +13,19 @@ import sqlmodel
 from fastapi import FastAPI
 from fastapi.responses import ORJSONResponse
 from sqlmodel.ext.asyncio.session import AsyncSession
+from utils.admission import AdmissionMiddleware, load_route_classes
+from utils.explain import QueryPlanGuard
+from utils.profiling import SAMPLE_INTERVAL, ProfileStore, ProfilingMiddleware
+from utils.startup import startup
+from utils.tasks import PeriodicTask
 
 if TYPE_CHECKING:
+    from utils.assets import AssetCache
     from utils.config import KaedeConfig
+    from utils.jobs import JobWorker
+    from utils.popularity import TrendingCache
+    from utils.shmcache import SharedCache
+    from utils.similar import TagIndex
     from utils.types import Database
 
 __title__ = "Kaede"
@@ -48,6 +61,34 @@ class Kaede(FastAPI):
             json_serializer=orjson.dumps,
             json_deserializer=orjson.loads,
         )
+        admission = self.config.get("admission", {})
+        if admission.get("enabled", True):
+            self.add_middleware(
+                AdmissionMiddleware,
+                route_classes=load_route_classes(admission.get("classes", {})),
+            )
+
+        # Added last, so that profiles include time spent in admission control
+        profiling = self.config.get("profiling", {})
+        if profiling.get("enabled", False):
+            self.add_middleware(
+                ProfilingMiddleware,
+                store=ProfileStore(
+                    Path(profiling.get("directory", "profiles")),
+                    keep=profiling.get("keep", 100),
+                ),
+                token=profiling.get("token"),
+                sample_rate=profiling.get("sample_rate", 0.0),
+                interval=profiling.get("interval", SAMPLE_INTERVAL),
+            )
+
+        self.tasks: list[PeriodicTask] = []
+        self.query_plan_guard: Optional[QueryPlanGuard] = None
+        self.tag_index: TagIndex
+        self.trending: TrendingCache
+        self.shared_cache: Optional[SharedCache] = None
+        self.asset_cache: AssetCache
+        self.job_worker: Optional[JobWorker] = None
 
     ### Server-related utilities
 
@@ -58,10 +99,257 @@ class Kaede(FastAPI):
         return AsyncSession(self.engine)
 
     async def init_db(self) -> None:
-        async with self.engine.begin() as connection:
-            await connection.run_sync(sqlmodel.SQLModel.metadata.create_all)
+        """
+        This function makes sure the database schema is up to date.
+
+        The launcher applies migrations once before starting workers, so this
+        is normally a single ``PRAGMA user_version`` check. Migrations are only
+        applied here when the app is started some other way.
+        """
+        # Imported lazily, as the db package imports this module
+        from db import migrations
+
+        async with self.engine.connect() as connection:
+            version = await connection.run_sync(migrations.get_version)
+
+        if version != migrations.SCHEMA_VERSION:
+            await asyncio.to_thread(migrations.migrate, self.config["sqlite_url"])
+
+    def guard_query_plans(self) -> None:
+        """
+        This function attaches a query plan guard to the engine when enabled
+        via ``explain_query_plans`` in the config (``warn`` or ``strict``).
+        """
+        mode = self.config.get("explain_query_plans", "off")
+        if not mode or mode == "off":
+            return
+
+        self.query_plan_guard = QueryPlanGuard(
+            tables=sqlmodel.SQLModel.metadata.tables.keys(),
+            ignore=self.config.get("explain_ignore_tables", []),
+            strict=mode == "strict",
+        )
+        self.query_plan_guard.attach(self.engine.sync_engine)
+
+    def lease_worker_id(self) -> int:
+        """
+        This function leases a unique Snowflake worker ID for this process.
+        """
+        # Imported lazily, as the db package imports this module
+        from db import id as ids
+
+        lease_dir = self.config.get("id_lease_dir")
+        return ids.configure(Path(lease_dir) if lease_dir else ids.default_lease_dir())
+
+    def attach_shared_cache(self) -> None:
+        """
+        This function attaches to the cache shared by all workers, when enabled
+        via ``shared_cache`` in the config.
+        """
+        from db.migrations import SCHEMA_VERSION
+        from utils.shmcache import SharedCache
+
+        config = self.config.get("shared_cache", {})
+        if not config.get("enabled", True):
+            return
+
+        path = config.get("path")
+        self.shared_cache = SharedCache(
+            Path(path) if path else None,
+            slots=config.get("slots", 16384),
+            slot_size=config.get("slot_size", 1024),
+            # Entries cached by other versions are invalidated on deploy
+            stamp=f"{__version__}:{SCHEMA_VERSION}",
+        )
+
+    def create_asset_cache(self) -> None:
+        from utils.assets import AssetCache
+
+        config = self.config.get("asset_cache", {})
+        self.asset_cache = AssetCache(
+            max_bytes=config.get("max_bytes", 64 * 1024 * 1024),
+            max_item_bytes=config.get("max_item_bytes", 256 * 1024),
+            ttl=config.get("ttl", 60),
+        )
+
+    @property
+    def tag_index_snapshot(self) -> Path:
+        similar = self.config.get("similar_books", {})
+        return Path(similar.get("snapshot", "tag-index.json"))
+
+    async def load_tag_index(self) -> None:
+        """
+        This function loads the tag index used for book recommendations,
+        preferably from its on-disk snapshot.
+        """
+        from utils.similar import TagIndex
+
+        self.tag_index = TagIndex()
+        async with self.get() as db:
+            await self.tag_index.restore(db, self.tag_index_snapshot)
+
+    async def save_tag_index(self) -> None:
+        async with self.get() as db:
+            await self.tag_index.refresh(db)
+        await asyncio.to_thread(self.tag_index.save, self.tag_index_snapshot)
+
+    async def load_trending(self) -> None:
+        """
+        This function loads the trending books listing served from memory.
+        """
+        from utils.popularity import TrendingCache
+
+        trending = self.config.get("trending_books", {})
+        self.trending = TrendingCache(trending.get("limit", 50))
+        await self.refresh_trending()
+
+    async def refresh_trending(self) -> None:
+        async with self.get() as db:
+            await self.trending.refresh(db)
+
+    def create_tasks(self) -> list[PeriodicTask]:
+        """
+        This function creates the background tasks run by each worker.
+        """
+        from utils.assets import AssetSweeper
+        from utils.backup import BackupRunner, database_path
+        from utils.sessions import sweep_expired_sessions
+
+        sweeper = self.config.get("session_sweeper", {})
+        similar = self.config.get("similar_books", {})
+        trending = self.config.get("trending_books", {})
+        asset_gc = self.config.get("asset_sweeper", {})
+        backup = self.config.get("backup", {})
+
+        async def sweep_sessions() -> None:
+            async with self.get() as db:
+                await sweep_expired_sessions(
+                    db,
+                    batch_size=sweeper.get("batch_size", 500),
+                    time_budget=sweeper.get("time_budget", 0.5),
+                )
+
+        asset_sweeper = AssetSweeper(
+            grace_period=timedelta(seconds=asset_gc.get("grace_period", 3600)),
+            batch_size=asset_gc.get("batch_size", 100),
+            time_budget=asset_gc.get("time_budget", 0.5),
+        )
+
+        async def sweep_assets() -> None:
+            async with self.get() as db:
+                await asset_sweeper.sweep(db)
+
+        async def refresh_tag_index() -> None:
+            async with self.get() as db:
+                await self.tag_index.refresh(db)
+
+        tasks = [
+            PeriodicTask(
+                "session-sweeper", sweeper.get("interval", 300), sweep_sessions
+            ),
+            PeriodicTask("asset-sweeper", asset_gc.get("interval", 600), sweep_assets),
+            PeriodicTask(
+                "tag-index-refresh",
+                similar.get("refresh_interval", 60),
+                refresh_tag_index,
+            ),
+            PeriodicTask(
+                "trending-refresh",
+                trending.get("refresh_interval", 30),
+                self.refresh_trending,
+            ),
+        ]
+
+        if backup.get("enabled", False):
+            backup_interval = backup.get("interval", 86400)
+            backup_runner = BackupRunner(
+                database_path(self.config["sqlite_url"]),
+                Path(backup.get("directory", "backups")),
+                keep=backup.get("keep", 7),
+                pages=backup.get("pages", 256),
+                step_delay=backup.get("step_delay", 0.01),
+            )
+
+            async def back_up_database() -> None:
+                # Every worker checks, but only one takes each snapshot
+                await backup_runner.run(backup_interval)
+
+            tasks.append(
+                PeriodicTask(
+                    "database-backup",
+                    backup.get("check_interval", 300),
+                    back_up_database,
+                )
+            )
+
+        return tasks
+
+    def create_job_worker(self) -> Optional[JobWorker]:
+        """
+        This function creates the worker running queued jobs, if enabled.
+        """
+        from utils.jobs import JobWorker
+
+        config = self.config.get("job_queue", {})
+        if not config.get("enabled", True):
+            return None
+        return JobWorker(
+            self.get,
+            concurrency=config.get("concurrency", 4),
+            batch_size=config.get("batch_size", 10),
+            poll_interval=config.get("poll_interval", 1.0),
+            lease=timedelta(seconds=config.get("lease", 300)),
+        )
 
     @asynccontextmanager
     async def lifespan(self, app: Self):
-        await self.init_db()
-        yield
+        with startup.phase("lease worker id"):
+            self.lease_worker_id()
+        with startup.phase("check database schema"):
+            await self.init_db()
+        self.guard_query_plans()
+
+        with startup.phase("attach shared cache"):
+            self.attach_shared_cache()
+
+        with startup.phase("create asset cache"):
+            self.create_asset_cache()
+
+        with startup.phase("load tag index"):
+            await self.load_tag_index()
+
+        with startup.phase("load trending books"):
+            await self.load_trending()
+
+        with startup.phase("start background tasks"):
+            self.tasks = self.create_tasks()
+            for task in self.tasks:
+                task.start()
+
+        with startup.phase("start job worker"):
+            self.job_worker = self.create_job_worker()
+            if self.job_worker is not None:
+                self.job_worker.start()
+
+        if os.environ.get("KAEDE_PROFILE_STARTUP"):
+            print(startup.report(title=f"Worker [{os.getpid()}]"), flush=True)
+
+        try:
+            yield
+        finally:
+            if self.job_worker is not None:
+                await self.job_worker.stop(
+                    self.config.get("job_queue", {}).get("shutdown_timeout", 5.0)
+                )
+
+            for task in self.tasks:
+                await task.stop()
+
+            await self.save_tag_index()
+
+            if self.shared_cache is not None:
+                self.shared_cache.close()
+
+            from db import id as ids
+
+            ids.release()
@@ -1,6 +1,7 @@
 from __future__ import annotations
 
-from typing import TYPE_CHECKING, AsyncGenerator
+import math
+from typing import TYPE_CHECKING, AsyncGenerator, Optional
 
 import sqlalchemy
 from fastapi import HTTPException
@@ -15,9 +16,41 @@ if TYPE_CHECKING:
 @sqlalchemy.event.listens_for(sqlalchemy.engine.Engine, "connect")
 def set_sqlite_pragma(conn, _):
     cursor = conn.cursor()
+    # wal2 needs a SQLite build from its branch, and is silently ignored by
+    # others, so fall back to WAL
     cursor.execute("PRAGMA journal_mode=wal2")
+    (mode,) = cursor.fetchone()  # aiosqlite's execute() returns no cursor
+    if mode.lower() not in ("wal", "wal2"):
+        cursor.execute("PRAGMA journal_mode=wal")
     cursor.execute("PRAGMA foreign_keys=ON")
     cursor.close()
+    conn.create_function("logaddexp", 2, logaddexp, deterministic=True)
+    conn.create_function("logsubexp", 2, logsubexp, deterministic=True)
+
+
+def logaddexp(a: Optional[float], b: Optional[float]) -> Optional[float]:
+    """
+    This function returns log(exp(a) + exp(b)) without overflowing, treating
+    NULL as log(0). It is available to SQL as logaddexp().
+    """
+    if a is None or b is None:
+        return b if a is None else a
+
+    high, low = (a, b) if a > b else (b, a)
+    return high + math.log1p(math.exp(low - high))
+
+
+def logsubexp(a: Optional[float], b: Optional[float]) -> Optional[float]:
+    """
+    This function returns log(exp(a) - exp(b)), treating NULL as log(0). A
+    difference of zero or less, e.g. from rounding when removing the last
+    term, is NULL. It is available to SQL as logsubexp().
+    """
+    if a is None or b is None:
+        return a
+    if b >= a:
+        return None
+    return a + math.log1p(-math.exp(b - a))
 
 
 # For async info on SQLModel, see
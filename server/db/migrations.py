@@ -0,0 +1,343 @@
+from __future__ import annotations
+
+import logging
+import math
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Callable
+
+import sqlalchemy
+from sqlalchemy.dialects.sqlite import insert
+from sqlmodel import SQLModel, col, delete, func, select, update
+from utils.popularity import trending_offset
+from utils.similar import BOOK_TAG_CHANGES_KEPT
+
+from . import models as models
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    description: str
+    apply: Callable[[sqlalchemy.Connection], None]
+
+
+def create_all(conn: sqlalchemy.Connection) -> None:
+    SQLModel.metadata.create_all(conn)
+
+
+def create_indexes(*names: str) -> Callable[[sqlalchemy.Connection], None]:
+    """
+    This function returns a migration step that creates the named indexes, as
+    declared on the models.
+    """
+
+    def apply(conn: sqlalchemy.Connection) -> None:
+        indexes: dict[str, sqlalchemy.Index] = {
+            str(index.name): index
+            for table in SQLModel.metadata.tables.values()
+            for index in table.indexes
+        }
+        # Expression indexes are not reflected, so checkfirst would not see
+        # them
+        existing = set(
+            conn.exec_driver_sql(
+                "SELECT name FROM sqlite_master WHERE type = 'index'"
+            ).scalars()
+        )
+        for name in names:
+            if name not in existing:
+                indexes[name].create(conn)
+
+    return apply
+
+
+def create_tables(*names: str) -> Callable[[sqlalchemy.Connection], None]:
+    """
+    This function returns a migration step that creates the named tables and
+    their indexes, as declared on the models.
+    """
+
+    def apply(conn: sqlalchemy.Connection) -> None:
+        SQLModel.metadata.create_all(
+            conn, tables=[SQLModel.metadata.tables[name] for name in names]
+        )
+
+    return apply
+
+
+def add_book_stats(conn: sqlalchemy.Connection) -> None:
+    create_tables("bookstats")(conn)
+
+    # Existing collections have no timestamp, so count them as made now
+    offset = trending_offset()
+    counts = conn.execute(
+        select(models.UserCollection.book_id, func.count()).group_by(
+            models.UserCollection.book_id  # type: ignore
+        )
+    ).all()
+    if not counts:
+        return
+
+    conn.execute(
+        insert(models.BookStats)
+        .values(
+            [
+                {
+                    "book_id": book_id,
+                    "collections": count,
+                    "trending": offset + math.log(count),
+                }
+                for book_id, count in counts
+            ]
+        )
+        .on_conflict_do_nothing()
+    )
+
+
+def add_collected_at(conn: sqlalchemy.Connection) -> None:
+    columns = conn.exec_driver_sql("PRAGMA table_info(usercollection)").all()
+    if not any(column[1] == "collected_at" for column in columns):
+        # SQLite only accepts constant defaults when adding a column, so
+        # existing collections are stamped with the time of the migration.
+        now = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f")
+        conn.exec_driver_sql(
+            "ALTER TABLE usercollection ADD COLUMN collected_at DATETIME "
+            f"NOT NULL DEFAULT '{now}'"
+        )
+    create_indexes("ix_usercollection_user_id_collected_at_book_id")(conn)
+
+
+def track_table_versions(*names: str) -> Callable[[sqlalchemy.Connection], None]:
+    """
+    This function returns a migration step that adds triggers bumping the
+    tableversion row of each named table whenever it changes.
+    """
+
+    def apply(conn: sqlalchemy.Connection) -> None:
+        create_tables("tableversion")(conn)
+        for name in names:
+            conn.execute(
+                insert(models.TableVersion)
+                .values(name=name, version=0)
+                .on_conflict_do_nothing()
+            )
+            bump = (
+                update(models.TableVersion)
+                .where(col(models.TableVersion.name) == name)
+                .values(version=col(models.TableVersion.version) + 1)
+                .compile(conn, compile_kwargs={"literal_binds": True})
+            )
+            for event in ("insert", "update", "delete"):
+                conn.exec_driver_sql(
+                    f"CREATE TRIGGER IF NOT EXISTS {name}_version_{event} "
+                    f"AFTER {event.upper()} ON {name} BEGIN {bump}; END"
+                )
+
+    return apply
+
+
+def log_book_tag_changes(conn: sqlalchemy.Connection) -> None:
+    """
+    This function replaces the triggers bumping the version of booktags with
+    ones that also log the book whose tags changed at the new version, and
+    drop the versions older than the last BOOK_TAG_CHANGES_KEPT.
+    """
+    create_tables("booktagchange")(conn)
+    version = (
+        select(models.TableVersion.version)
+        .where(col(models.TableVersion.name) == "booktags")
+        .scalar_subquery()
+    )
+    bump = (
+        update(models.TableVersion)
+        .where(col(models.TableVersion.name) == "booktags")
+        .values(version=col(models.TableVersion.version) + 1)
+    )
+    prune = delete(models.BookTagChange).where(
+        col(models.BookTagChange.version) <= version - BOOK_TAG_CHANGES_KEPT
+    )
+
+    # An update may move a link to another book, which changes the tags of both
+    for event, rows in (
+        ("insert", ["NEW"]),
+        ("update", ["OLD", "NEW"]),
+        ("delete", ["OLD"]),
+    ):
+        log = [
+            insert(models.BookTagChange)
+            .from_select(
+                ["version", "book_id"],
+                select(
+                    col(models.TableVersion.version),
+                    sqlalchemy.literal_column(f"{row}.book_id"),
+                ).where(col(models.TableVersion.name) == "booktags"),
+            )
+            .on_conflict_do_nothing()
+            for row in rows
+        ]
+        body = "; ".join(
+            str(statement.compile(conn, compile_kwargs={"literal_binds": True}))
+            for statement in [bump, *log, prune]
+        )
+        conn.exec_driver_sql(f"DROP TRIGGER IF EXISTS booktags_version_{event}")
+        conn.exec_driver_sql(
+            f"CREATE TRIGGER IF NOT EXISTS booktags_change_{event} "
+            f"AFTER {event.upper()} ON booktags BEGIN {body}; END"
+        )
+
+
+def rebuild_table(name: str) -> Callable[[sqlalchemy.Connection], None]:
+    """
+    This function returns a migration step that rebuilds the named table as
+    declared on the model, keeping its rows. This makes changes that ALTER
+    TABLE cannot, such as to the primary key.
+    """
+
+    def apply(conn: sqlalchemy.Connection) -> None:
+        table = SQLModel.metadata.tables[name]
+        # Under a temporary name, next to the tables it refers to
+        metadata = sqlalchemy.MetaData()
+        for key in table.foreign_keys:
+            key.column.table.to_metadata(metadata)
+        rebuilt = table.to_metadata(metadata, name=f"{name}_rebuilt")
+
+        # Following https://www.sqlite.org/lang_altertable.html#otheralter,
+        # which needs foreign keys to be off, see migrate()
+        conn.execute(sqlalchemy.schema.CreateTable(rebuilt))
+        conn.execute(
+            sqlalchemy.insert(rebuilt).from_select(
+                list(table.columns.keys()), sqlalchemy.select(table)
+            )
+        )
+        conn.exec_driver_sql(f'DROP TABLE "{name}"')
+        conn.exec_driver_sql(f'ALTER TABLE "{rebuilt.name}" RENAME TO "{name}"')
+        for index in table.indexes:
+            index.create(conn)
+
+    return apply
+
+
+# Migrations are applied in order and the database's PRAGMA user_version
+# records the last one applied. The first migration creates the schema as
+# currently declared by the models, so a fresh database already has the
+# changes made by later migrations. Every migration must therefore be
+# idempotent (checkfirst, IF NOT EXISTS, ...).
+MIGRATIONS: list[Migration] = [
+    Migration(1, "Initial schema", create_all),
+    Migration(
+        2,
+        "Index sessions and route lookups",
+        create_indexes(
+            "ix_session_expires_at",
+            "ix_user_email",
+            "ix_author_name",
+            "ix_tags_name",
+            "ix_book_owner_id",
+            "ix_book_created_at_id",
+        ),
+    ),
+    Migration(
+        3,
+        "Index book browsing filters",
+        create_indexes(
+            "ix_booktags_book_id_tag_id",
+            "ix_book_author_created_at_id",
+            "ix_book_owner_created_at_id",
+        ),
+    ),
+    Migration(4, "Add book stats", add_book_stats),
+    Migration(5, "Track when books were collected", add_collected_at),
+    Migration(
+        6,
+        "Index asset references",
+        create_indexes(
+            "ix_asset_created_at",
+            "ix_user_avatar_hash",
+            "ix_author_avatar_hash",
+            "ix_book_image_hash",
+            "ix_userphoto_photo_hash",
+            "ix_commentmessage_asset_hash",
+        ),
+    ),
+    Migration(7, "Add the job queue", create_tables("job")),
+    Migration(8, "Track changes to book tags", track_table_versions("booktags")),
+    Migration(
+        9,
+        "Index book deletion",
+        create_indexes("ix_usercollection_book_id", "ix_commentmessage_book_id"),
+    ),
+    # Books refer to authors by id alone, which SQLite rejects as a foreign key
+    # while it is only part of the primary key
+    Migration(10, "Make the author id the primary key", rebuild_table("author")),
+    Migration(
+        11,
+        "Index user deletion",
+        create_indexes("ix_session_user_id", "ix_commentmessage_author_id"),
+    ),
+    Migration(12, "Log changes to book tags", log_book_tag_changes),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1].version
+
+
+class SchemaVersionError(RuntimeError):
+    pass
+
+
+def to_sync_url(url: str) -> sqlalchemy.URL:
+    """
+    This function converts an async SQLite URL (sqlite+aiosqlite) into the
+    equivalent URL for the synchronous driver.
+    """
+    return sqlalchemy.make_url(url).set(drivername="sqlite")
+
+
+def get_version(conn: sqlalchemy.Connection) -> int:
+    return conn.exec_driver_sql("PRAGMA user_version").scalar_one()
+
+
+def migrate(url: str) -> int:
+    """
+    This function applies all pending migrations to the database and returns
+    the schema version.
+
+    The migrations run in a single ``BEGIN IMMEDIATE`` transaction, which
+    takes SQLite's write lock up front. Concurrent callers therefore wait for
+    each other, and find nothing left to do once they get the lock.
+    """
+    engine = sqlalchemy.create_engine(to_sync_url(url), isolation_level="AUTOCOMMIT")
+    try:
+        with engine.connect() as conn:
+            # Rebuilt tables are briefly missing while other tables refer to
+            # them. Foreign keys cannot be switched off within a transaction.
+            conn.exec_driver_sql("PRAGMA foreign_keys=OFF")
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+            try:
+                version = get_version(conn)
+                if version > SCHEMA_VERSION:
+                    raise SchemaVersionError(
+                        f"Database schema version {version} is newer than "
+                        f"this server's version {SCHEMA_VERSION}"
+                    )
+
+                for migration in MIGRATIONS[version:]:
+                    logger.info(
+                        "Applying migration %d: %s",
+                        migration.version,
+                        migration.description,
+                    )
+                    migration.apply(conn)
+                    version = migration.version
+
+                conn.exec_driver_sql(f"PRAGMA user_version = {version}")
+                conn.exec_driver_sql("COMMIT")
+            except BaseException:
+                conn.exec_driver_sql("ROLLBACK")
+                raise
+    finally:
+        engine.dispose()
+
+    return version
@@ -8,7 +8,9 @@ from sqlmodel import (
     JSON,
     Column,
     Field,
+    Index,
     SQLModel,
+    text,
 )
 
 from .id import generate_id
@@ -23,8 +25,9 @@ class RoleAccess(int, Enum):
 
 class Session(SQLModel, table=True):
     token: str = Field(primary_key=True)
-    user_id: Optional[int] = Field(foreign_key="user.id")
-    expires_at: datetime = Field(default=datetime.now(timezone.utc))
+    # Indexed to check the foreign key when a user is deleted
+    user_id: Optional[int] = Field(foreign_key="user.id", index=True)
+    expires_at: datetime = Field(default=datetime.now(timezone.utc), index=True)
 
 
 class Asset(SQLModel, table=True):
@@ -36,45 +39,58 @@ class Asset(SQLModel, table=True):
 
     hash: str = Field(primary_key=True)
     data: bytes
-    created_at: datetime = Field(default=datetime.now(timezone.utc))
+    created_at: datetime = Field(
+        default_factory=lambda: datetime.now(timezone.utc), index=True
+    )
     content_type: str
     alt: str | None = Field(default=None)
 
 
 # We need to put some validation
 class Book(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_book_owner_id", "owner", "id"),
+        Index("ix_book_created_at_id", "created_at", "id"),
+        Index("ix_book_author_created_at_id", "author", "created_at", "id"),
+        Index("ix_book_owner_created_at_id", "owner", "created_at", "id"),
+    )
+
     id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
     title: str = Field(index=True)
     description: str
-    image_hash: Optional[str] = Field(default=None, foreign_key="asset.hash")
+    image_hash: Optional[str] = Field(
+        default=None, foreign_key="asset.hash", index=True
+    )
     author: int = Field(default=None, foreign_key="author.id")
     owner: int = Field(default=None, foreign_key="user.id")
-    created_at: datetime = Field(default=datetime.now(timezone.utc))
-    updated_at: datetime = Field(default=datetime.now(timezone.utc))
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 
 class User(SQLModel, table=True):
     id: int = Field(default_factory=generate_id, primary_key=True)
     name: str
-    email: str
+    email: str = Field(index=True)
     bio: str
-    avatar_hash: Optional[str] = Field(default=None, foreign_key="asset.hash")
+    avatar_hash: Optional[str] = Field(
+        default=None, foreign_key="asset.hash", index=True
+    )
     created_at: datetime = Field(default=datetime.now(timezone.utc))
 
 
 class Tags(SQLModel, table=True):
     id: int = Field(primary_key=True)
-    name: str = Field(nullable=False)
+    name: str = Field(nullable=False, index=True)
     description: str
 
 
 class Author(SQLModel, table=True):
+    __table_args__ = (Index("ix_author_avatar_hash", "avatar_hash"),)
+
     id: int = Field(default_factory=generate_id, primary_key=True)
-    name: str
+    name: str = Field(index=True)
     bio: str
-    avatar_hash: Optional[str] = Field(
-        default=None, foreign_key="asset.hash", primary_key=True
-    )
+    avatar_hash: Optional[str] = Field(default=None, foreign_key="asset.hash")
     created_at: datetime = Field(default=datetime.now(timezone.utc))
 
 
@@ -112,6 +128,18 @@ CommentContent = Annotated[
 
 
 class CommentMessage(SQLModel, table=True):
+    __table_args__ = (
+        # The asset referenced by sticker and image comments. Queries must use
+        # the same expression, with the path inlined, to use this index.
+        Index(
+            "ix_commentmessage_asset_hash",
+            text("json_extract(content, '$.asset_hash')"),
+        ),
+        # Check the foreign keys when a book or user is deleted
+        Index("ix_commentmessage_book_id", "book_id"),
+        Index("ix_commentmessage_author_id", "author_id"),
+    )
+
     # id is the unique identifier for the message.
     # It is defined as a Snowflake ID and therefore also contains a timestamp.
     id: int = Field(default_factory=generate_id, primary_key=True)
@@ -126,6 +154,8 @@ class CommentMessage(SQLModel, table=True):
 
 
 class UserPhoto(SQLModel, table=True):
+    __table_args__ = (Index("ix_userphoto_photo_hash", "photo_hash"),)
+
     user_id: Optional[int] = Field(foreign_key="user.id", primary_key=True)
     photo_hash: Optional[str] = Field(
         default=None, foreign_key="asset.hash", primary_key=True
@@ -141,16 +171,95 @@ class UserPassword(SQLModel, table=True):
 
 
 class UserCollection(SQLModel, table=True):
+    # Covers listing a user's collection newest first without visiting the
+    # table.
+    __table_args__ = (
+        Index(
+            "ix_usercollection_user_id_collected_at_book_id",
+            "user_id",
+            "collected_at",
+            "book_id",
+        ),
+        # Deletes the collections of a deleted book
+        Index("ix_usercollection_book_id", "book_id"),
+    )
+
     user_id: Optional[int] = Field(
         default=None, foreign_key="user.id", primary_key=True
     )
     book_id: Optional[uuid.UUID] = Field(
         default=None, foreign_key="book.id", primary_key=True
     )
+    collected_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+
+class BookStats(SQLModel, table=True):
+    """
+    Counters for a book, maintained in the same transaction as the changes
+    they count.
+    """
+
+    __table_args__ = (Index("ix_bookstats_trending", "trending"),)
+
+    book_id: Optional[uuid.UUID] = Field(
+        default=None, foreign_key="book.id", primary_key=True
+    )
+    collections: int = Field(default=0)
+    # The natural log of the time-decayed collection count, scaled to a fixed
+    # epoch so that it never needs to be decayed in place.
+    # See utils.popularity for details.
+    trending: Optional[float] = Field(default=None)
 
 
 class BookTags(SQLModel, table=True):
+    __table_args__ = (Index("ix_booktags_book_id_tag_id", "book_id", "tag_id"),)
+
     tag_id: Optional[int] = Field(default=None, foreign_key="tags.id", primary_key=True)
     book_id: Optional[uuid.UUID] = Field(
         default=None, foreign_key="book.id", primary_key=True
     )
+
+
+class TableVersion(SQLModel, table=True):
+    """
+    A counter bumped by triggers on every change to a table, so that workers
+    can tell whether what they derived from the table is stale. Unlike a row
+    count or the highest rowid, it never repeats a value.
+    """
+
+    name: str = Field(primary_key=True)
+    version: int = Field(default=0)
+
+
+class BookTagChange(SQLModel, table=True):
+    """
+    The book whose tags changed at each version of the booktags table, logged
+    by the triggers bumping it, so that workers can catch up on the changes
+    since their watermark instead of rebuilding their tag index. Only recent
+    versions are kept, see utils.similar.
+    """
+
+    version: int = Field(primary_key=True)
+    # Not a foreign key, the book may since have been deleted
+    book_id: uuid.UUID = Field(primary_key=True)
+
+
+class Job(SQLModel, table=True):
+    """
+    Work deferred until after a request, run by the job workers.
+    See utils.jobs for details.
+    """
+
+    id: int = Field(default_factory=generate_id, primary_key=True)
+    kind: str
+    payload: dict = Field(default={}, sa_column=Column(JSON))
+    # When the job may be claimed next. Claiming a job pushes this past its
+    # lease, so that jobs of crashed workers are claimed again. NULL once the
+    # job has failed for good.
+    run_at: Optional[datetime] = Field(
+        default_factory=lambda: datetime.now(timezone.utc), index=True
+    )
+    attempts: int = Field(default=0)
+    max_attempts: int = Field(default=5)
+    last_error: Optional[str] = Field(default=None)
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
@@ -2,18 +2,48 @@ import argparse
 import os
 import sys
 from pathlib import Path
+from typing import Union
 
 import uvicorn
 from core import Kaede
-from routes import router
+from db.migrations import migrate
+from routes import load_router
+from utils.backup import BackupRunner, database_path
 from utils.config import KaedeConfig
+from utils.prefork import PreforkSupervisor
+from utils.startup import startup
 from uvicorn.supervisors import Multiprocess
 
 config_path = Path(__file__).parent / "config.yml"
 config = KaedeConfig(config_path)
 
-app = Kaede(config=config)
-app.include_router(router)
+
+def create_app(config: KaedeConfig) -> Kaede:
+    with startup.phase("create app"):
+        app = Kaede(config=config)
+    with startup.phase("load routes"):
+        app.include_router(load_router())
+    return app
+
+
+def warm_app(app: Kaede) -> None:
+    """
+    This function does the work that is otherwise done lazily on the first
+    requests, so that forked workers inherit the result.
+    """
+    with startup.phase("generate openapi schema"):
+        app.openapi()
+
+
+def __getattr__(name: str):
+    # Workers import launcher:app, which builds the app on first use. The
+    # launcher only builds it to preload it, so that supervising spawned
+    # workers does not import every route module.
+    if name == "app":
+        app = globals()["app"] = create_app(config)
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -38,22 +68,90 @@ if __name__ == "__main__":
         help="Runs no workers",
     )
     parser.add_argument("-w", "--workers", default=os.cpu_count() or 1, type=int)
+    parser.add_argument(
+        "--preload",
+        action="store_true",
+        default=False,
+        help="Loads and warms the app once, then forks workers from it",
+    )
+    parser.add_argument(
+        "--profile-startup",
+        action="store_true",
+        default=False,
+        help="Prints how long each startup phase takes",
+    )
+    parser.add_argument(
+        "--migrate",
+        action="store_true",
+        default=False,
+        help="Applies pending database migrations and exits",
+    )
+    parser.add_argument(
+        "--backup",
+        action="store_true",
+        default=False,
+        help="Takes a snapshot of the database while it is in use and exits",
+    )
 
     args = parser.parse_args(sys.argv[1:])
     use_workers = not args.no_workers
     worker_count = args.workers
 
-    config = uvicorn.Config(
-        "launcher:app", port=args.port, host=args.host, access_log=True
+    if args.profile_startup:
+        # Inherited by workers, which report their own startup
+        os.environ["KAEDE_PROFILE_STARTUP"] = "1"
+
+    if args.backup:
+        backup = config.get("backup", {})
+        path = BackupRunner(
+            database_path(config["sqlite_url"]),
+            Path(backup.get("directory", "backups")),
+            keep=backup.get("keep", 7),
+            pages=backup.get("pages", 256),
+            step_delay=backup.get("step_delay", 0.01),
+        ).backup()
+        if path is None:
+            print("Another process is backing up the database", file=sys.stderr)
+            sys.exit(1)
+        print(f"Backed up the database to {path}")
+        sys.exit(0)
+
+    # Migrate once here, so workers only need to check the schema version
+    with startup.phase("migrate"):
+        version = migrate(config["sqlite_url"])
+    if args.migrate:
+        print(f"Database schema is at version {version}")
+        sys.exit(0)
+
+    target: Union[Kaede, str] = "launcher:app"
+    if args.preload:
+        target = create_app(config)
+        warm_app(target)
+
+    if args.profile_startup:
+        print(startup.report(title=f"Launcher [{os.getpid()}]"))
+
+    server_config = uvicorn.Config(
+        target,
+        port=args.port,
+        host=args.host,
+        access_log=True,
     )
 
-    server = uvicorn.Server(config)
+    server = uvicorn.Server(server_config)
+
+    if use_workers and args.preload:
+        server_config.workers = worker_count
+        sock = server_config.bind_socket()
 
-    if use_workers:
-        config.workers = worker_count
-        sock = config.bind_socket()
+        runner = PreforkSupervisor(
+            server_config, sockets=[sock], workers=worker_count, on_fork=startup.reset
+        )
+    elif use_workers:
+        server_config.workers = worker_count
+        sock = server_config.bind_socket()
 
-        runner = Multiprocess(config, target=server.run, sockets=[sock])
+        runner = Multiprocess(server_config, target=server.run, sockets=[sock])
     else:
         runner = server
 
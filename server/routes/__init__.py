@@ -1,11 +1,28 @@
 import importlib
+from functools import cache
 from pkgutil import iter_modules
 
 from fastapi import APIRouter
+from utils.startup import startup
 
-router = APIRouter()
 route_modules = [module.name for module in iter_modules(__path__, f"{__package__}.")]
 
-for route in route_modules:
-    module = importlib.import_module(route)
-    router.include_router(module.router)
+
+@cache
+def load_router() -> APIRouter:
+    """
+    This function imports every route module and returns a router including
+    all of them. Route modules are only imported on the first call.
+    """
+    router = APIRouter()
+    for route in route_modules:
+        with startup.phase(f"import {route}"):
+            module = importlib.import_module(route)
+        router.include_router(module.router)
+    return router
+
+
+def __getattr__(name: str):
+    if name == "router":
+        return load_router()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,15 +1,16 @@
-import io
 from typing import Annotated, Any, Optional
 
 import db
 from db.models import (
     Asset,
 )
-from fastapi import APIRouter, Depends, HTTPException, UploadFile
-from fastapi.responses import StreamingResponse
+from fastapi import APIRouter, Depends, HTTPException, Response, UploadFile
 from pydantic import BaseModel
-from sqlmodel import select
-from utils.assets import hash_bytes
+from sqlalchemy import case
+from sqlmodel import col, func, select
+from utils.assets import AssetCache, CachedAsset, hash_bytes
+from utils.batch import BatchGetRequest, BatchGetResponse, in_request_order
+from utils.requests import RouteRequest
 from utils.sessions import authorize
 from utils.types import Database
 
@@ -32,19 +33,31 @@ router = APIRouter(tags=["assets"])
 )
 async def get_asset(
     asset_hash: str,
+    request: RouteRequest,
     me_id: Annotated[int, Depends(authorize)],
     db: Annotated[Database, Depends(db.use)],
-) -> StreamingResponse:
+) -> Response:
     """
     This function returns an asset by hash.
     """
 
-    asset = (await db.exec(select(Asset).where(Asset.hash == asset_hash))).first()
+    cache = request.app.asset_cache
+    asset = cache.get(asset_hash)
     if asset is None:
-        raise HTTPException(status_code=404, detail="Not found")
+        row = (
+            await db.exec(
+                select(Asset.content_type, Asset.alt, Asset.data).where(
+                    Asset.hash == asset_hash
+                )
+            )
+        ).first()
+        if row is None:
+            raise HTTPException(status_code=404, detail="Not found")
+
+        asset = CachedAsset(*row)
+        cache.put(asset_hash, asset)
 
-    stream = io.BytesIO(asset.data)
-    return StreamingResponse(stream, media_type=asset.content_type)
+    return Response(asset.data, media_type=asset.content_type)
 
 
 class GetAssetMetadataResponse(BaseModel):
@@ -55,6 +68,7 @@ class GetAssetMetadataResponse(BaseModel):
 @router.get("/assets/{asset_hash}/metadata")
 async def get_asset_metadata(
     asset_hash: str,
+    request: RouteRequest,
     db: Annotated[Database, Depends(db.use)],
     me: str = Depends(authorize),
 ) -> GetAssetMetadataResponse:
@@ -62,11 +76,65 @@ async def get_asset_metadata(
     This function returns metadata for an asset by hash.
     """
 
-    asset = (await db.exec(select(Asset).where(Asset.hash == asset_hash))).first()
-    if asset is None:
+    metadata = await fetch_asset_metadata(db, request.app.asset_cache, [asset_hash])
+    if asset_hash not in metadata:
         raise HTTPException(status_code=404, detail="Not found")
 
-    return GetAssetMetadataResponse(**asset.model_dump())
+    return metadata[asset_hash]
+
+
+@router.post("/assets/metadata:batchGet")
+async def batch_get_asset_metadata(
+    req: BatchGetRequest[str],
+    request: RouteRequest,
+    db: Annotated[Database, Depends(db.use)],
+    me: str = Depends(authorize),
+) -> BatchGetResponse[str, GetAssetMetadataResponse]:
+    """
+    This function returns metadata for multiple assets by hash.
+    """
+
+    metadata = await fetch_asset_metadata(db, request.app.asset_cache, req.ids)
+    return in_request_order(req.ids, metadata)
+
+
+async def fetch_asset_metadata(
+    db: Database, cache: AssetCache, hashes: list[str]
+) -> dict[str, GetAssetMetadataResponse]:
+    """
+    This function returns the metadata of the given assets that exist, keyed
+    by hash. Assets that are not cached are fetched in one query, along with
+    their data if it is small enough to be cached.
+    """
+    metadata = {}
+    missing = []
+    for hash in dict.fromkeys(hashes):
+        asset = cache.get(hash)
+        if asset is None:
+            missing.append(hash)
+        else:
+            metadata[hash] = GetAssetMetadataResponse(
+                content_type=asset.content_type, alt=asset.alt
+            )
+
+    if not missing:
+        return metadata
+
+    # length() reads a blob's size without loading it
+    small_data = case(
+        (func.length(Asset.data) <= cache.max_item_bytes, col(Asset.data)),
+        else_=None,
+    )
+    assets = await db.exec(
+        select(Asset.hash, Asset.content_type, Asset.alt, small_data).where(
+            col(Asset.hash).in_(missing)
+        )
+    )
+    for hash, content_type, alt, data in assets:
+        metadata[hash] = GetAssetMetadataResponse(content_type=content_type, alt=alt)
+        if data is not None:
+            cache.put(hash, CachedAsset(content_type, alt, data))
+    return metadata
 
 
 class UploadFileResponse(BaseModel):
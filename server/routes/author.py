@@ -1,13 +1,12 @@
-import uuid
 from typing import Annotated, Optional
 
 import db
 from db.models import Author
-from fastapi import APIRouter, Depends
-from fastapi_pagination.ext.sqlmodel import paginate
+from fastapi import APIRouter, Depends, Response
 from pydantic import BaseModel
-from sqlmodel import delete, desc, select
-from utils.pages import KaedeParams
+from sqlmodel import col, delete, desc, select
+from utils.batch import BatchGetRequest, BatchGetResponse, in_request_order
+from utils.pages import KaedePages, KaedeParams, paginate_rows, select_fields
 from utils.responses import OkResponse
 from utils.sessions import authorize
 from utils.types import Database
@@ -17,18 +16,26 @@ from .assets import assert_asset_hash
 router = APIRouter(tags=["Authors"])
 
 
-@router.get("/author")
+@router.get("/author", response_model=KaedePages[Author])
 async def list_authors(
     db: Annotated[Database, Depends(db.use)],
     *,
     params: Annotated[KaedeParams, Depends()],
-):
-    query = select(Author).order_by(desc(Author.name))
-    return paginate(db, query, params)
+) -> Response:
+    query = select(*select_fields(Author, None)).order_by(desc(Author.name))
+    return await paginate_rows(db, query, params)
+
+
+@router.post("/author:batchGet")
+async def batch_get_authors(
+    req: BatchGetRequest[int], *, db: Annotated[Database, Depends(db.use)]
+) -> BatchGetResponse[int, Author]:
+    authors = await db.exec(select(Author).where(col(Author.id).in_(set(req.ids))))
+    return in_request_order(req.ids, {author.id: author for author in authors})
 
 
 @router.get("/author/{id}")
-async def get_author(id: uuid.UUID, *, db: Annotated[Database, Depends(db.use)]):
+async def get_author(id: int, *, db: Annotated[Database, Depends(db.use)]):
     return (await db.exec(select(Author).where(Author.id == id))).one()
 
 
@@ -39,7 +46,7 @@ class EditAuthorResponse(BaseModel):
 
 @router.patch("/author/{id}")
 async def edit_author(
-    id: uuid.UUID,
+    id: int,
     req: EditAuthorResponse,
     *,
     db: Annotated[Database, Depends(db.use)],
@@ -76,5 +83,5 @@ async def delete_author(
     me_id: Annotated[int, Depends(authorize)],
     db: Annotated[Database, Depends(db.use)],
 ):
-    await db.delete(delete(Author).where(Author.id == id))  # type: ignore # Pyright is tripping up again...
+    await db.execute(delete(Author).where(col(Author.id) == id))
     return OkResponse()
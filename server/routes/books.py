@@ -1,35 +1,203 @@
 import uuid
-from typing import Annotated
+from datetime import datetime, timezone
+from enum import Enum
+from typing import Annotated, Optional
 
 import db
-from db.models import Book, Tags
-from fastapi import APIRouter, Depends
-from fastapi_pagination.ext.sqlmodel import paginate
+import orjson
+from db.models import Book, BookStats, BookTags, Tags, UserCollection
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
 from pydantic import BaseModel
-from sqlmodel import desc, select
-from utils.pages import KaedePages, KaedeParams
+from sqlmodel import col, delete, desc, func, select
+from utils.batch import BatchGetRequest, BatchGetResponse, in_request_order
+from utils.pages import (
+    FieldsQuery,
+    KaedeCursorPage,
+    KaedeCursorParams,
+    KaedePages,
+    KaedeParams,
+    cursor_params,
+    paginate_keyset,
+    paginate_rows,
+    select_fields,
+)
+from utils.requests import RouteRequest
 from utils.responses import OkResponse
 from utils.sessions import authorize
+from utils.similar import SimilarBook, fetch_watermark
 from utils.types import Database
 
 router = APIRouter(tags=["books"])
 
 
-@router.get("/books")
+@router.get("/books", response_model=KaedePages[Book])
 async def get_books(
     db: Annotated[Database, Depends(db.use)],
     *,
     params: Annotated[KaedeParams, Depends()],
-) -> KaedePages[Book]:
+    fields: FieldsQuery = None,
+) -> Response:
     """Get a paginated list of books"""
-    query = select(Book).order_by(desc(Book.created_at))
-    return await paginate(db, query, params)
+    query = select(*select_fields(Book, fields)).order_by(
+        desc(Book.created_at), desc(Book.id)
+    )
+    return await paginate_rows(db, query, params)
 
 
-@router.get("/books/{id}")
-async def get_book(id: uuid.UUID, *, db: Annotated[Database, Depends(db.use)]) -> Book:
+class TagMatch(str, Enum):
+    ALL = "all"
+    ANY = "any"
+
+
+class TagFacet(BaseModel):
+    name: str
+    count: int
+
+
+class BrowseBooksResponse(KaedeCursorPage[Book]):
+    # Only computed for the first page, as it covers the whole result set
+    facets: Optional[list[TagFacet]] = None
+
+
+FACET_LIMIT = 50
+
+
+@router.get("/books/browse", response_model=BrowseBooksResponse)
+async def browse_books(
+    db: Annotated[Database, Depends(db.use)],
+    *,
+    params: Annotated[KaedeCursorParams, Depends(cursor_params)],
+    tags: Annotated[
+        Optional[str], Query(description="Comma-separated list of tag names")
+    ] = None,
+    match: TagMatch = TagMatch.ALL,
+    author: Optional[int] = None,
+    owner: Optional[int] = None,
+    facets: bool = True,
+    fields: FieldsQuery = None,
+) -> Response:
+    """
+    Get the newest books matching the given filters, along with how many of
+    them carry each tag
+    """
+    conditions = []
+    if author is not None:
+        conditions.append(Book.author == author)
+    if owner is not None:
+        conditions.append(Book.owner == owner)
+
+    names = (
+        {name.strip() for name in tags.split(",") if name.strip()} if tags else set()
+    )
+    if names:
+        tag_ids = (
+            await db.exec(select(Tags.id).where(col(Tags.name).in_(names)))
+        ).all()
+        if match is TagMatch.ALL and len(tag_ids) != len(names):
+            tag_ids = []
+
+        tagged = select(BookTags.book_id).where(col(BookTags.tag_id).in_(tag_ids))
+        if match is TagMatch.ALL:
+            tagged = tagged.group_by(col(BookTags.book_id)).having(
+                func.count() == len(tag_ids)
+            )
+        conditions.append(col(Book.id).in_(tagged))
+
+    extra = {}
+    if facets and not params.cursor:
+        counts = await db.exec(
+            select(Tags.name, func.count())
+            .select_from(BookTags)
+            .join(Tags, col(Tags.id) == BookTags.tag_id)
+            .where(col(BookTags.book_id).in_(select(Book.id).where(*conditions)))
+            .group_by(col(BookTags.tag_id))
+            .order_by(desc(func.count()), col(Tags.name))
+            .limit(FACET_LIMIT)
+        )
+        extra["facets"] = [{"name": name, "count": count} for name, count in counts]
+
+    query = select(*select_fields(Book, fields, required=("created_at", "id"))).where(
+        *conditions
+    )
+    keys = (
+        col(Book.created_at).label("created_at"),
+        col(Book.id).label("id"),
+    )
+    return await paginate_keyset(db, query, keys, params, **extra)
+
+
+@router.get(
+    "/books/trending",
+    responses={
+        200: {
+            "content": {"application/json": {}},
+            "description": "The most trending books with their decayed collection counts",
+        }
+    },
+)
+async def get_trending_books(request: RouteRequest) -> Response:
+    """
+    Get the books collected the most recently, refreshed periodically.
+    Each collection counts for half as much every three days.
+    """
+    return Response(request.app.trending.body, media_type="application/json")
+
+
+@router.post("/books:batchGet")
+async def batch_get_books(
+    req: BatchGetRequest[uuid.UUID], *, db: Annotated[Database, Depends(db.use)]
+) -> BatchGetResponse[uuid.UUID, Book]:
+    """Gets information about multiple books specified via ID"""
+    books = await db.exec(select(Book).where(col(Book.id).in_(set(req.ids))))
+    return in_request_order(req.ids, {book.id: book for book in books})
+
+
+# Books are cached across workers as rendered JSON
+BOOK_CACHE_TTL = 300  # seconds
+
+
+def cache_version(updated_at: datetime) -> int:
+    """
+    This function returns the shared cache version of a book last updated at
+    the given time, in microseconds. SQLite returns naive UTC datetimes.
+    """
+    if updated_at.tzinfo is None:
+        updated_at = updated_at.replace(tzinfo=timezone.utc)
+    return int(updated_at.timestamp() * 1_000_000)
+
+
+@router.get("/books/{id}", response_model=Book)
+async def get_book(
+    id: uuid.UUID, request: RouteRequest, *, db: Annotated[Database, Depends(db.use)]
+) -> Response:
     """Gets information about a book specified via ID"""
-    return (await db.exec(select(Book).where(Book.id == id))).one()
+    cache = request.app.shared_cache
+    if cache is not None and (body := cache.get("book", id.bytes)):
+        return Response(body, media_type="application/json")
+
+    book = (await db.exec(select(Book).where(Book.id == id))).one()
+    body = orjson.dumps(book.model_dump())
+    if cache is not None:
+        # Refused if the book was updated since it was read
+        cache.set(
+            "book",
+            id.bytes,
+            body,
+            BOOK_CACHE_TTL,
+            version=cache_version(book.updated_at),
+        )
+    return Response(body, media_type="application/json")
+
+
+@router.get("/books/{id}/similar")
+async def get_similar_books(
+    id: uuid.UUID,
+    request: RouteRequest,
+    *,
+    limit: Annotated[int, Query(ge=1, le=50)] = 10,
+) -> list[SimilarBook]:
+    """Gets the books sharing the most tags with a book"""
+    return request.app.tag_index.similar(id, limit)
 
 
 class EditBookResponse(BaseModel):
@@ -41,6 +209,7 @@ class EditBookResponse(BaseModel):
 async def edit_book(
     id: uuid.UUID,
     req: EditBookResponse,
+    request: RouteRequest,
     *,
     me_id: Annotated[int, Depends(authorize)],
     db: Annotated[Database, Depends(db.use)],
@@ -50,18 +219,58 @@ async def edit_book(
     ).one()
     for key, value in req.model_dump().items():
         setattr(book, key, value)
+    book.updated_at = datetime.now(timezone.utc)
 
+    db.add(book)
+    await db.commit()
     await db.refresh(book)
+
+    # Only invalidated once committed, so that the old book cannot be cached
+    # again in between. The tombstone keeps requests that read the old book
+    # before the commit from caching it afterwards.
+    if request.app.shared_cache is not None:
+        request.app.shared_cache.delete(
+            "book",
+            id.bytes,
+            version=cache_version(book.updated_at),
+            ttl=BOOK_CACHE_TTL,
+        )
     return book
 
 
 @router.delete("/books/{id}")
 async def delete_book(
     id: uuid.UUID,
+    request: RouteRequest,
     me_id: Annotated[int, Depends(authorize)],
     db: Annotated[Database, Depends(db.use)],
 ):
-    await db.delete(select(Book).where(Book.id == id).where(Book.owner == me_id))
+    book = (
+        await db.exec(select(Book).where(Book.id == id).where(Book.owner == me_id))
+    ).one()
+
+    removed = (
+        await db.execute(
+            delete(BookTags)
+            .where(col(BookTags.book_id) == id)
+            .returning(col(BookTags.tag_id))
+        )
+    ).all()
+    await db.execute(delete(UserCollection).where(col(UserCollection.book_id) == id))
+    await db.execute(delete(BookStats).where(col(BookStats.book_id) == id))
+    await db.delete(book)
+    watermark = await fetch_watermark(db)
+    await db.commit()
+
+    request.app.tag_index.remove(id)
+    request.app.tag_index.advance(watermark, len(removed))
+    if request.app.shared_cache is not None:
+        request.app.shared_cache.delete(
+            "book",
+            id.bytes,
+            version=cache_version(datetime.now(timezone.utc)),
+            ttl=BOOK_CACHE_TTL,
+        )
     return OkResponse()
 
 
@@ -75,20 +284,26 @@ class CreateBookResponse(BaseModel):
 @router.post("/books/create")
 async def create_book(
     req: CreateBookResponse,
+    request: RouteRequest,
     *,
     me_id: Annotated[int, Depends(authorize)],
     db: Annotated[Database, Depends(db.use)],
 ) -> Book:
+    tag_ids = (
+        await db.exec(select(Tags.id).where(col(Tags.name).in_(set(req.tags))))
+    ).all()
+    if len(tag_ids) != len(set(req.tags)):
+        raise HTTPException(status_code=400, detail="Tag does not exist")
+
     async with db.begin_nested():
-        book = Book(owner=me_id, **req.model_dump(exclude={"tags": False}))
+        book = Book(owner=me_id, **req.model_dump(exclude={"tags"}))
         db.add(book)
-        db.add_all(
-            [
-                (await db.exec(select(Tags).where(Tags.name == tag))).one()
-                for tag in req.tags
-            ]
-        )
+        db.add_all([BookTags(tag_id=tag_id, book_id=book.id) for tag_id in tag_ids])
 
+    watermark = await fetch_watermark(db)
     await db.commit()
     await db.refresh(book)
+
+    request.app.tag_index.set_tags(book.id, tag_ids)
+    request.app.tag_index.advance(watermark, len(tag_ids))
     return book
@@ -1,4 +1,6 @@
-from typing import Annotated, Optional
+import uuid
+from datetime import datetime, timezone
+from typing import Annotated, Optional, Sequence
 
 import db
 from db.id import generate_id
@@ -10,14 +12,28 @@ from db.models import (
     UserPassword,
     UserPhoto,
 )
-from fastapi import APIRouter, Depends, HTTPException
-from fastapi_pagination.ext.sqlmodel import paginate
+from fastapi import APIRouter, Depends, HTTPException, Response
 from pydantic import BaseModel
+from sqlalchemy import DateTime, literal
+from sqlalchemy.dialects.sqlite import insert
 from sqlmodel import (
     Field,
+    col,
+    delete,
     select,
 )
-from utils.pages import KaedePages, KaedeParams
+from utils.batch import BatchGetRequest, BatchGetResponse, in_request_order
+from utils.jobs import enqueue
+from utils.pages import (
+    FieldsQuery,
+    KaedeCursorPage,
+    KaedeCursorParams,
+    cursor_params,
+    paginate_keyset,
+    select_fields,
+)
+from utils.popularity import record_collected, record_uncollected
+from utils.responses import OkResponse
 from utils.sessions import authorize, hash_password, new_session, verify_password
 from utils.types import Database
 
@@ -103,6 +119,38 @@ async def get_self(
     return MeResponse(**user.model_dump())
 
 
+class UserResponse(BaseModel):
+    id: int
+    name: str
+    bio: str
+    avatar_hash: Optional[str]
+
+
+@router.post("/users:batchGet")
+async def batch_get_users(
+    req: BatchGetRequest[int],
+    me_id: Annotated[int, Depends(authorize)],
+    db: Annotated[Database, Depends(db.use)],
+) -> BatchGetResponse[int, UserResponse]:
+    """
+    This function returns the public profiles of multiple users.
+    """
+    users = (
+        await db.exec(
+            select(User.id, User.name, User.bio, User.avatar_hash).where(
+                col(User.id).in_(set(req.ids))
+            )
+        )
+    ).all()
+    return in_request_order(
+        req.ids,
+        {
+            id: UserResponse(id=id, name=name, bio=bio, avatar_hash=avatar_hash)
+            for id, name, bio, avatar_hash in users
+        },
+    )
+
+
 class UpdateUserRequest(RegisterRequest):
     avatar_hash: Optional[str] = None
     photo_hashes: list[str] = []
@@ -125,6 +173,10 @@ async def update_user(
     password = (
         await db.exec(select(UserPassword).where(UserPassword.id == me_id))
     ).one()
+    # Assets the user no longer refers to, deleted after the update commits
+    dropped_hashes = []
+    if req.avatar_hash != user.avatar_hash and user.avatar_hash is not None:
+        dropped_hashes.append(user.avatar_hash)
 
     for key, value in req.model_dump().items():
         match key:
@@ -148,6 +200,7 @@ async def update_user(
         if photo.photo_hash not in req.photo_hashes:
             # Old photo is not in new photos, delete it.
             await db.delete(photo)
+            dropped_hashes.append(photo.photo_hash)
         else:
             # Old photo is in new photos, remove it from new photos.
             new_photos.remove(photo.photo_hash)
@@ -159,25 +212,160 @@ async def update_user(
     db.add(user)
     db.add(password)
 
+    if dropped_hashes:
+        enqueue(db, "delete-unreferenced-assets", {"hashes": dropped_hashes})
+
     await db.commit()
     await db.refresh(user)
 
     return user
 
 
-@router.get("/users/me/books")
+class CollectedBook(Book):
+    collected_at: datetime
+
+
+@router.get("/users/me/books", response_model=KaedeCursorPage[CollectedBook])
 async def get_my_books(
     me_id: Annotated[int, Depends(authorize)],
     db: Annotated[Database, Depends(db.use)],
     *,
-    params: Annotated[KaedeParams, Depends()],
-) -> KaedePages[Book]:
-    """Get the authenticated user's collection of books"""
+    params: Annotated[KaedeCursorParams, Depends(cursor_params)],
+    fields: FieldsQuery = None,
+) -> Response:
+    """Get the authenticated user's collection of books, most recently collected first"""
+    # The keys are read from the collection so that pages are served in index
+    # order, and labelled so that they stand in for the book's own ID.
+    keys = (
+        col(UserCollection.collected_at).label("collected_at"),
+        col(UserCollection.book_id).label("id"),
+    )
+    columns = [
+        keys[1],
+        *(
+            column
+            for column in select_fields(Book, fields)
+            if column.key not in ("id", "collected_at")
+        ),
+        keys[0],
+    ]
     query = (
-        select(User)
-        .join(UserCollection)
-        .join(Book)
+        select(*columns)
+        .select_from(UserCollection)
+        .join(Book, col(Book.id) == UserCollection.book_id)
         .where(UserCollection.user_id == me_id)
-        .where(Book.id == UserCollection.book_id)
     )
-    return await paginate(db, query, params)
+    return await paginate_keyset(db, query, keys, params)
+
+
+# Collections are synced in bulk, so this is larger than BATCH_LIMIT
+COLLECTION_BATCH_LIMIT = 1000
+
+
+class CollectionRequest(BaseModel):
+    ids: list[uuid.UUID] = Field(min_length=1, max_length=COLLECTION_BATCH_LIMIT)
+
+
+class CollectionResponse(BaseModel):
+    """
+    The books that were added or removed. Books that were already in the
+    requested state, or do not exist, are left out.
+    """
+
+    ids: list[uuid.UUID]
+
+
+async def collect_books(
+    db: Database, user_id: int, book_ids: Sequence[uuid.UUID]
+) -> list[uuid.UUID]:
+    """
+    This function adds books to a user's collection in a single statement and
+    returns the ones that were not collected yet.
+    """
+    now = datetime.now(timezone.utc)
+    added = (
+        (
+            await db.execute(
+                insert(UserCollection)
+                .from_select(
+                    ["user_id", "book_id", "collected_at"],
+                    select(literal(user_id), Book.id, literal(now, DateTime())).where(
+                        col(Book.id).in_(set(book_ids))
+                    ),
+                )
+                .on_conflict_do_nothing()
+                .returning(col(UserCollection.book_id))
+            )
+        )
+        .scalars()
+        .all()
+    )
+    await record_collected(db, added, now)
+    return list(added)
+
+
+async def uncollect_books(
+    db: Database, user_id: int, book_ids: Sequence[uuid.UUID]
+) -> list[uuid.UUID]:
+    """
+    This function removes books from a user's collection in a single
+    statement and returns the ones that were collected.
+    """
+    removed = (
+        (
+            await db.execute(
+                delete(UserCollection)
+                .where(col(UserCollection.user_id) == user_id)
+                .where(col(UserCollection.book_id).in_(set(book_ids)))
+                .returning(
+                    col(UserCollection.book_id), col(UserCollection.collected_at)
+                )
+            )
+        )
+        .tuples()
+        .all()
+    )
+    await record_uncollected(db, removed)
+    return [book_id for book_id, _ in removed]
+
+
+@router.post("/users/me/books")
+async def collect_many_books(
+    req: CollectionRequest,
+    me_id: Annotated[int, Depends(authorize)],
+    db: Annotated[Database, Depends(db.use)],
+) -> CollectionResponse:
+    """Adds books to the authenticated user's collection"""
+    return CollectionResponse(ids=await collect_books(db, me_id, req.ids))
+
+
+@router.delete("/users/me/books")
+async def uncollect_many_books(
+    req: CollectionRequest,
+    me_id: Annotated[int, Depends(authorize)],
+    db: Annotated[Database, Depends(db.use)],
+) -> CollectionResponse:
+    """Removes books from the authenticated user's collection"""
+    return CollectionResponse(ids=await uncollect_books(db, me_id, req.ids))
+
+
+@router.put("/users/me/books/{id}")
+async def collect_book(
+    id: uuid.UUID,
+    me_id: Annotated[int, Depends(authorize)],
+    db: Annotated[Database, Depends(db.use)],
+):
+    """Adds a book to the authenticated user's collection"""
+    await collect_books(db, me_id, [id])
+    return OkResponse()
+
+
+@router.delete("/users/me/books/{id}")
+async def uncollect_book(
+    id: uuid.UUID,
+    me_id: Annotated[int, Depends(authorize)],
+    db: Annotated[Database, Depends(db.use)],
+):
+    """Removes a book from the authenticated user's collection"""
+    await uncollect_books(db, me_id, [id])
+    return OkResponse()
@@ -12,7 +12,11 @@ router = APIRouter(tags=["Tags"])
 
 @router.get("/tags")
 async def list_tags(db: Annotated[Database, Depends(db.use)]):
-    return (await db.exec(select(Tags).order_by(desc(Tags.name)))).all()
+    # Lists every tag on purpose, tags being a small vocabulary
+    query = (
+        select(Tags).order_by(desc(Tags.name)).execution_options(allow_full_scan=True)
+    )
+    return (await db.exec(query)).all()
 
 
 class TagCreateResponse(BaseModel):
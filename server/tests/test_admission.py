@@ -0,0 +1,155 @@
+from __future__ import annotations
+
+import asyncio
+from typing import Any, Awaitable, TypeVar
+
+import pytest
+from utils.admission import (
+    AdmissionMiddleware,
+    AdmissionQueue,
+    OverloadedError,
+    RouteClass,
+)
+
+T = TypeVar("T")
+
+ROUTE_CLASS = RouteClass("writes", limit=1, queue=2, timeout=1.0)
+
+
+def run(awaitable: Awaitable[T]) -> T:
+    # Unlike asyncio.run(), leaves the current event loop, which the app in
+    # test_query_plans uses, alone
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(awaitable)
+    finally:
+        loop.close()
+
+
+async def queued(queue: AdmissionQueue, count: int) -> list[asyncio.Task[None]]:
+    tasks = [asyncio.create_task(queue.acquire()) for _ in range(count)]
+    # Lets the tasks reach the queue
+    await asyncio.sleep(0)
+    return tasks
+
+
+def test_sheds_when_the_queue_is_full():
+    async def scenario() -> None:
+        queue = AdmissionQueue(ROUTE_CLASS)
+        await queue.acquire()
+        waiters = await queued(queue, ROUTE_CLASS.queue)
+
+        with pytest.raises(OverloadedError) as error:
+            await queue.acquire()
+        assert error.value.reason == "queue_full"
+
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+
+    run(scenario())
+
+
+def test_sheds_requests_that_would_miss_the_deadline():
+    async def scenario() -> None:
+        queue = AdmissionQueue(ROUTE_CLASS)
+        await queue.acquire()
+        queue.release(service_time=5.0)
+        await queue.acquire()
+
+        # The slot is expected to be held for longer than the timeout
+        with pytest.raises(OverloadedError) as error:
+            await queue.acquire()
+        assert error.value.reason == "deadline"
+        assert error.value.retry_after == 5.0
+
+    run(scenario())
+
+
+def test_sheds_waiters_past_the_timeout():
+    async def scenario() -> None:
+        queue = AdmissionQueue(RouteClass("writes", limit=1, queue=2, timeout=0.01))
+        await queue.acquire()
+
+        with pytest.raises(OverloadedError) as error:
+            await queue.acquire()
+        assert error.value.reason == "timeout"
+        assert not queue._waiters
+
+    run(scenario())
+
+
+def test_release_hands_the_slot_to_the_first_waiter():
+    async def scenario() -> None:
+        queue = AdmissionQueue(ROUTE_CLASS)
+        await queue.acquire()
+        first, second = await queued(queue, 2)
+
+        queue.release()
+        await first
+        assert not second.done()
+        assert queue.active == 1
+
+        # A request arriving now waits behind the second one
+        late = await queued(queue, 1)
+        queue.release()
+        await second
+        assert not late[0].done()
+
+        queue.release()
+        await late[0]
+        queue.release()
+        assert queue.active == 0
+
+    run(scenario())
+
+
+def test_cancelled_waiters_do_not_lose_the_slot():
+    async def scenario() -> None:
+        queue = AdmissionQueue(ROUTE_CLASS)
+        await queue.acquire()
+        first, second = await queued(queue, 2)
+
+        # The slot is handed to the first waiter as it is cancelled
+        queue.release()
+        first.cancel()
+        (result,) = await asyncio.gather(first, return_exceptions=True)
+        if not isinstance(result, asyncio.CancelledError):
+            # Admitted all the same, depending on the Python version, so it
+            # holds the slot until it releases it
+            queue.release()
+
+        await second
+        assert queue.active == 1
+
+    run(scenario())
+
+
+def test_middleware_rejects_shed_requests():
+    async def scenario() -> list[dict[str, Any]]:
+        release = asyncio.Event()
+
+        async def app(scope, receive, send) -> None:
+            await release.wait()
+
+        middleware = AdmissionMiddleware(
+            app,
+            route_classes={"writes": RouteClass("writes", limit=1, queue=0, timeout=1)},
+        )
+        scope = {"type": "http", "method": "POST", "path": "/books/create"}
+        sent: list[dict[str, Any]] = []
+
+        async def send(message) -> None:
+            sent.append(message)
+
+        admitted = asyncio.create_task(middleware(scope, None, send))  # type: ignore
+        await asyncio.sleep(0)
+        await middleware(scope, None, send)  # type: ignore
+        release.set()
+        await admitted
+        return sent
+
+    start, body = run(scenario())
+    assert start["status"] == 503
+    assert (b"retry-after", b"1") in start["headers"]
+    assert body["type"] == "http.response.body"
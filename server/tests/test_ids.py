@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+import multiprocessing
+from pathlib import Path
+
+import pytest
+from db import id as ids
+
+WORKERS = 4
+IDS_PER_WORKER = 3 * (ids.MAX_SEQUENCE + 1)
+
+
+def worker_id(id: int) -> int:
+    return (id >> ids.SEQUENCE_BITS) & ids.MAX_WORKER_ID
+
+
+@pytest.fixture
+def generator(tmp_path: Path) -> ids.IdGenerator:
+    return ids.IdGenerator(ids.WorkerLease(tmp_path))
+
+
+def test_reserve_borrows_the_next_millisecond(
+    generator: ids.IdGenerator, monkeypatch: pytest.MonkeyPatch
+):
+    # A frozen clock, so that every ID past the first 4096 overflows the
+    # sequence of the current millisecond
+    monkeypatch.setattr(ids, "_now_ms", lambda: 1_000)
+
+    block = generator.reserve(IDS_PER_WORKER)
+    single = [generator.next_id() for _ in range(10)]
+    minted = block + single
+
+    assert len(set(minted)) == len(minted)
+    assert minted == sorted(minted)
+    assert (
+        minted[ids.MAX_SEQUENCE + 1] >> (ids.WORKER_ID_BITS + ids.SEQUENCE_BITS)
+        == 1_001
+    )
+    assert {worker_id(id) for id in minted} == {generator.lease.worker_id}
+
+
+def test_reserve_continues_after_the_borrowed_milliseconds(
+    generator: ids.IdGenerator, monkeypatch: pytest.MonkeyPatch
+):
+    now = 1_000
+    monkeypatch.setattr(ids, "_now_ms", lambda: now)
+    first = generator.reserve(IDS_PER_WORKER)
+
+    # The wall clock catches up with only part of the borrowed milliseconds
+    now = 1_001
+    second = generator.reserve(10)
+
+    assert min(second) > max(first)
+
+
+def test_reserve_rejects_negative_counts(generator: ids.IdGenerator):
+    assert generator.reserve(0) == []
+    with pytest.raises(ValueError):
+        generator.reserve(-1)
+
+
+def test_leases_are_exclusive(tmp_path: Path):
+    leases = [ids.WorkerLease(tmp_path) for _ in range(3)]
+    try:
+        assert [lease.acquire() for lease in leases] == [0, 1, 2]
+        leases[1].release()
+        assert ids.WorkerLease(tmp_path).acquire() == 1
+    finally:
+        for lease in leases:
+            lease.release()
+
+
+def mint(lease_dir: Path, barrier, queue) -> None:
+    ids.configure(lease_dir)
+    # Mint at the same time as every other worker
+    barrier.wait()
+    queue.put(ids.generate_ids(IDS_PER_WORKER))
+
+
+def test_forked_workers_mint_unique_ids(tmp_path: Path):
+    # The parent holds a lease when forking, which its children inherit
+    ids.configure(tmp_path)
+    try:
+        context = multiprocessing.get_context("fork")
+        barrier = context.Barrier(WORKERS)
+        queue = context.Queue()
+        workers = [
+            context.Process(target=mint, args=(tmp_path, barrier, queue))
+            for _ in range(WORKERS)
+        ]
+        for worker in workers:
+            worker.start()
+        minted = [queue.get(timeout=30) for _ in workers]
+        for worker in workers:
+            worker.join(timeout=30)
+            assert worker.exitcode == 0
+
+        parent = ids.generate_ids(IDS_PER_WORKER)
+    finally:
+        ids.release()
+
+    every_id = [id for block in [*minted, parent] for id in block]
+    assert len(set(every_id)) == len(every_id)
+    assert len({worker_id(block[0]) for block in [*minted, parent]}) == WORKERS + 1
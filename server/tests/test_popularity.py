@@ -0,0 +1,79 @@
+from __future__ import annotations
+
+import asyncio
+import sqlite3
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Optional
+
+import pytest
+from db.migrations import migrate
+from db.models import BookStats
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from utils.popularity import record_collected, record_uncollected
+
+BOOK = uuid.uuid4()
+NOW = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def database(tmp_path: Path) -> Path:
+    path = tmp_path / "database.db"
+    migrate(f"sqlite+aiosqlite:///{path}")
+
+    # Foreign keys are off in sqlite3 by default, so the owner and author
+    # need not exist
+    con = sqlite3.connect(path)
+    with con:
+        con.execute(
+            "INSERT INTO book (id, title, description, author, owner, created_at, "
+            "updated_at) VALUES (?, '', '', 1, 1, '2026-01-01', '2026-01-01')",
+            (BOOK.hex,),
+        )
+    con.close()
+    return path
+
+
+def collect_and_uncollect(
+    path: Path, collected_at: list[datetime]
+) -> tuple[int, Optional[float]]:
+    async def run() -> tuple[int, Optional[float]]:
+        engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+        try:
+            async with AsyncSession(engine) as db:
+                for at in collected_at:
+                    await record_collected(db, [BOOK], at)
+                for at in collected_at:
+                    await record_uncollected(db, [(BOOK, at)])
+                await db.commit()
+                return (
+                    await db.exec(
+                        select(BookStats.collections, BookStats.trending).where(
+                            BookStats.book_id == BOOK
+                        )
+                    )
+                ).one()
+        finally:
+            await engine.dispose()
+
+    # Unlike asyncio.run(), leaves the current event loop, which the app in
+    # test_query_plans uses, alone
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(run())
+    finally:
+        loop.close()
+
+
+def test_uncollecting_a_book_clears_its_score(database: Path):
+    assert collect_and_uncollect(database, [NOW]) == (0, None)
+
+
+def test_uncollecting_every_collection_clears_the_rounding_errors(database: Path):
+    # Taking both weights back out of their sum leaves a small positive
+    # remainder
+    collected_at = [NOW, NOW - timedelta(hours=16)]
+    assert collect_and_uncollect(database, collected_at) == (0, None)
@@ -0,0 +1,274 @@
+from __future__ import annotations
+
+import secrets
+import sqlite3
+import uuid
+from pathlib import Path
+from typing import Any, Iterator
+
+import pytest
+from core import Kaede
+from fastapi.routing import APIRoute
+from fastapi.testclient import TestClient
+from httpx import Response
+from routes import load_router
+from utils.backup import database_path
+from utils.config import KaedeConfig
+from utils.sessions import hash_password
+
+# Drives every route against a seeded database with the query plan guard in
+# strict mode, so that a route whose queries regress into a full table scan
+# fails with a QueryPlanError instead of only logging a warning.
+
+CONFIG_PATH = Path(__file__).parent.parent / "config.yml"
+PASSWORD = secrets.token_urlsafe()
+
+
+class Routes:
+    """
+    A test client that records which routes it requested, by their path
+    templates, so that routes without a request here are noticed.
+    """
+
+    def __init__(self, client: TestClient):
+        self.client = client
+        self.headers: dict[str, str] = {}
+        self.requested: set[tuple[str, str]] = set()
+
+    def request(self, method: str, path: str, **kwargs: Any) -> Response:
+        params = kwargs.pop("path_params", {})
+        self.requested.add((method, path))
+        response = self.client.request(
+            method, path.format(**params), headers=self.headers, **kwargs
+        )
+        assert response.status_code < 500, response.text
+        return response
+
+
+@pytest.fixture(scope="module")
+def app(tmp_path_factory: pytest.TempPathFactory) -> Kaede:
+    directory = tmp_path_factory.mktemp("kaede")
+    config = KaedeConfig(CONFIG_PATH)
+    config.all().update(
+        {
+            "sqlite_url": f"sqlite+aiosqlite:///{directory / 'database.db'}",
+            "echo": False,
+            "id_lease_dir": str(directory / "ids"),
+            "explain_query_plans": "strict",
+            "shared_cache": {"path": str(directory / "cache")},
+            "similar_books": {"snapshot": str(directory / "tag-index.json")},
+        }
+    )
+
+    app = Kaede(config=config)
+    app.include_router(load_router())
+    return app
+
+
+@pytest.fixture(scope="module")
+def routes(app: Kaede) -> Iterator[Routes]:
+    with TestClient(app) as client:
+        seed(database_path(app.config["sqlite_url"]))
+        routes = Routes(client)
+        token = routes.request(
+            "POST", "/login", json={"email": "kaede@example.com", "password": PASSWORD}
+        ).json()["token"]
+        routes.headers["Authorization"] = f"Bearer {token}"
+        yield routes
+
+
+def seed(path: Path) -> None:
+    """
+    This function adds the user to log in as, and the rows the routes need
+    that cannot be created through the API, such as authors.
+    """
+    con = sqlite3.connect(path)
+    with con:
+        con.execute(
+            "INSERT INTO asset (hash, data, content_type, created_at) "
+            "VALUES ('avatar', x'00', 'image/png', '2025-01-01 00:00:00')"
+        )
+        con.execute(
+            "INSERT INTO user (id, name, email, bio, created_at) "
+            "VALUES (1, 'Kaede', 'kaede@example.com', '', '2025-01-01 00:00:00')"
+        )
+        con.execute(
+            "INSERT INTO userpassword (id, passhash) VALUES (1, ?)",
+            (hash_password(PASSWORD),),
+        )
+        con.execute(
+            "INSERT INTO author (id, name, bio, avatar_hash, created_at) "
+            "VALUES (1, 'Author', '', 'avatar', '2025-01-01 00:00:00')"
+        )
+        con.executemany(
+            "INSERT INTO tags (id, name, description) VALUES (?, ?, '')",
+            [(i, f"tag-{i}") for i in range(1, 6)],
+        )
+    con.close()
+
+
+def create_book(routes: Routes, title: str, tags: list[str]) -> str:
+    return routes.request(
+        "POST",
+        "/books/create",
+        json={"title": title, "description": "", "author": 1, "tags": tags},
+    ).json()["id"]
+
+
+def test_asset_routes(routes: Routes):
+    asset = routes.request(
+        "POST",
+        "/assets",
+        params={"alt": "a sticker"},
+        files={"file": ("sticker.png", b"\x89PNG", "image/png")},
+    ).json()
+    hash = asset["hash"]
+
+    routes.request("GET", "/assets/{asset_hash}", path_params={"asset_hash": hash})
+    routes.request(
+        "GET", "/assets/{asset_hash}/metadata", path_params={"asset_hash": hash}
+    )
+    routes.request("POST", "/assets/metadata:batchGet", json={"ids": [hash, "missing"]})
+
+
+def test_tag_routes(routes: Routes):
+    routes.request("POST", "/tags/create", json={"name": "new", "description": ""})
+    routes.request(
+        "POST",
+        "/tags/bulk-create",
+        json=[
+            {"name": "bulk-1", "description": ""},
+            {"name": "bulk-2", "description": ""},
+        ],
+    )
+    routes.request("GET", "/tags")
+
+
+def test_author_routes(routes: Routes):
+    routes.request("GET", "/author")
+    routes.request("POST", "/author:batchGet", json={"ids": [1, 2]})
+    routes.request("GET", "/author/{id}", path_params={"id": 1})
+    routes.request(
+        "PATCH",
+        "/author/{id}",
+        path_params={"id": 1},
+        json={"name": "Renamed", "avatar_hash": "avatar"},
+    )
+    routes.request("DELETE", "/author/{id}", path_params={"id": 2})
+
+
+def test_book_routes(routes: Routes):
+    ids = [
+        create_book(routes, "First", ["tag-1", "tag-2"]),
+        create_book(routes, "Second", ["tag-1", "tag-3"]),
+        create_book(routes, "Third", ["tag-2"]),
+    ]
+
+    routes.request("GET", "/books", params={"fields": "id,title"})
+    page = routes.request(
+        "GET", "/books/browse", params={"size": 1, "tags": "tag-1", "match": "any"}
+    ).json()
+    routes.request(
+        "GET",
+        "/books/browse",
+        params={"size": 1, "tags": "tag-1,tag-2", "cursor": page["next_cursor"]},
+    )
+    routes.request(
+        "GET", "/books/browse", params={"owner": 1, "author": 1, "fields": "title"}
+    )
+    routes.request("GET", "/books/trending")
+    routes.request("POST", "/books:batchGet", json={"ids": [*ids, str(uuid.uuid4())]})
+    for _ in range(2):
+        routes.request("GET", "/books/{id}", path_params={"id": ids[0]})
+    routes.request(
+        "GET", "/books/{id}/similar", params={"limit": 5}, path_params={"id": ids[0]}
+    )
+    routes.request(
+        "PATCH",
+        "/books/{id}",
+        path_params={"id": ids[0]},
+        json={"title": "Renamed", "description": ""},
+    )
+    routes.request("DELETE", "/books/{id}", path_params={"id": ids[2]})
+
+
+def test_user_routes(routes: Routes):
+    ids = [
+        create_book(routes, "Collected", ["tag-4"]),
+        create_book(routes, "Also collected", ["tag-5"]),
+    ]
+
+    routes.request(
+        "POST",
+        "/register",
+        json={"bio": "", "email": "someone@example.com", "password": PASSWORD},
+    )
+    routes.request("GET", "/users/me")
+    routes.request("POST", "/users:batchGet", json={"ids": [1, 2]})
+    routes.request(
+        "PATCH",
+        "/users/me",
+        json={
+            "bio": "Hello",
+            "email": "kaede@example.com",
+            "password": PASSWORD,
+            "avatar_hash": "avatar",
+        },
+    )
+
+    routes.request("PUT", "/users/me/books/{id}", path_params={"id": ids[0]})
+    routes.request("POST", "/users/me/books", json={"ids": ids})
+    page = routes.request("GET", "/users/me/books", params={"size": 1}).json()
+    routes.request(
+        "GET",
+        "/users/me/books",
+        params={"size": 1, "fields": "title", "cursor": page["next_cursor"]},
+    )
+    routes.request("DELETE", "/users/me/books/{id}", path_params={"id": ids[0]})
+    routes.request("DELETE", "/users/me/books", json={"ids": ids})
+
+
+def test_metrics_route(routes: Routes):
+    routes.request("GET", "/metrics")
+
+
+def test_every_route_is_requested(app: Kaede, routes: Routes):
+    expected = {
+        (method, route.path)
+        for route in app.routes
+        if isinstance(route, APIRoute)
+        for method in route.methods
+    }
+    assert expected - routes.requested == set()
+
+
+def test_no_full_scans(app: Kaede, routes: Routes):
+    # Also covers statements run outside of requests, e.g. by the job worker
+    assert app.query_plan_guard is not None
+    assert app.query_plan_guard.violations == {}
+
+
+def test_foreign_keys_are_indexed(app: Kaede, routes: Routes):
+    # Deleting or updating a row makes SQLite look up the rows referring to it,
+    # which query plans do not show
+    con = sqlite3.connect(database_path(app.config["sqlite_url"]))
+    unindexed = []
+    for (table,) in con.execute("SELECT name FROM sqlite_schema WHERE type = 'table'"):
+        # The leading column of each index, and the rowid
+        indexed = {
+            next(column for _, _, column in con.execute(f"PRAGMA index_info({index})"))
+            for _, index, *_ in con.execute(f"PRAGMA index_list({table})")
+        }
+        primary_key = [
+            (column, type)
+            for _, column, type, _, _, pk in con.execute(f"PRAGMA table_info({table})")
+            if pk
+        ]
+        if len(primary_key) == 1 and primary_key[0][1].upper() == "INTEGER":
+            indexed.add(primary_key[0][0])
+
+        for _, _, _, column, *_ in con.execute(f"PRAGMA foreign_key_list({table})"):
+            if column not in indexed:
+                unindexed.append(f"{table}.{column}")
+    con.close()
+    assert unindexed == []
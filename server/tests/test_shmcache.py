@@ -0,0 +1,95 @@
+from __future__ import annotations
+
+from pathlib import Path
+from typing import Iterator
+
+import pytest
+from utils.shmcache import LAYOUT_VERSION, SharedCache
+
+TTL = 60.0
+
+
+@pytest.fixture
+def cache(tmp_path: Path) -> Iterator[SharedCache]:
+    cache = SharedCache(tmp_path / "cache", slots=64, slot_size=256)
+    yield cache
+    cache.close()
+
+
+def test_set_is_refused_over_a_newer_version(cache: SharedCache):
+    assert cache.set("book", b"1", b"new", TTL, version=2)
+    assert not cache.set("book", b"1", b"old", TTL, version=1)
+    assert cache.get("book", b"1") == b"new"
+
+    assert cache.set("book", b"1", b"newer", TTL, version=3)
+    assert cache.get("book", b"1") == b"newer"
+
+
+def test_tombstones_refuse_older_versions(cache: SharedCache):
+    cache.set("book", b"1", b"old", TTL, version=1)
+    cache.delete("book", b"1", version=2)
+    assert cache.get("book", b"1") is None
+
+    # A request that read the row before it was updated
+    assert not cache.set("book", b"1", b"old", TTL, version=1)
+    assert cache.get("book", b"1") is None
+
+    assert cache.set("book", b"1", b"new", TTL, version=2)
+    assert cache.get("book", b"1") == b"new"
+
+
+def test_tombstones_expire(cache: SharedCache):
+    cache.delete("book", b"1", version=2, ttl=0)
+    assert cache.set("book", b"1", b"old", TTL, version=1)
+
+
+def test_delete_without_a_version_leaves_no_tombstone(cache: SharedCache):
+    cache.set("book", b"1", b"new", TTL, version=2)
+    cache.delete("book", b"1")
+    assert cache.get("book", b"1") is None
+    assert cache.set("book", b"1", b"old", TTL, version=1)
+
+
+def test_workers_share_entries(tmp_path: Path, cache: SharedCache):
+    other = SharedCache(tmp_path / "cache", slots=64, slot_size=256)
+    try:
+        cache.set("book", b"1", b"value", TTL)
+        assert other.get("book", b"1") == b"value"
+        other.invalidate()
+        assert cache.get("book", b"1") is None
+    finally:
+        other.close()
+
+
+def test_other_layouts_map_their_own_file(tmp_path: Path, cache: SharedCache):
+    cache.set("book", b"1", b"value", TTL)
+
+    other = SharedCache(tmp_path / "cache", slots=128, slot_size=256)
+    try:
+        assert other.path != cache.path
+        assert other.get("book", b"1") is None
+    finally:
+        other.close()
+
+    # The first cache's file was left alone
+    assert cache.get("book", b"1") == b"value"
+
+
+def test_files_of_the_wrong_size_are_refused(tmp_path: Path):
+    cache = SharedCache(tmp_path / "cache", slots=64, slot_size=256)
+    cache.close()
+    with open(cache.path, "r+b") as file:
+        file.truncate(1024)
+
+    with pytest.raises(RuntimeError):
+        SharedCache(tmp_path / "cache", slots=64, slot_size=256)
+    assert cache.path.stat().st_size == 1024
+
+
+def test_symlinks_are_not_followed(tmp_path: Path):
+    target = tmp_path / "target"
+    (tmp_path / f"cache.v{LAYOUT_VERSION}-64x256").symlink_to(target)
+
+    with pytest.raises(OSError):
+        SharedCache(tmp_path / "cache", slots=64, slot_size=256)
+    assert not target.exists()
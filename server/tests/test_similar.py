@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+import asyncio
+import sqlite3
+import uuid
+from pathlib import Path
+
+import pytest
+from db.migrations import migrate
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
+from utils.similar import TagIndex
+
+BOOK = uuid.uuid4()
+OTHER = uuid.uuid4()
+
+
+@pytest.fixture
+def database(tmp_path: Path) -> Path:
+    path = tmp_path / "database.db"
+    migrate(f"sqlite+aiosqlite:///{path}")
+    return path
+
+
+def write(path: Path, *statements: tuple[str, tuple]) -> None:
+    # Stands in for another worker. Foreign keys are off in sqlite3 by default,
+    # so books and tags need not exist.
+    con = sqlite3.connect(path)
+    with con:
+        for statement in statements:
+            con.execute(*statement)
+    con.close()
+
+
+def link(book: uuid.UUID, tag: int) -> tuple[str, tuple]:
+    return ("INSERT INTO booktags (book_id, tag_id) VALUES (?, ?)", (book.hex, tag))
+
+
+def refresh(path: Path, *indexes: TagIndex) -> list[bool]:
+    async def run() -> list[bool]:
+        engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+        try:
+            async with AsyncSession(engine) as db:
+                return [await index.refresh(db) for index in indexes]
+        finally:
+            await engine.dispose()
+
+    # Unlike asyncio.run(), leaves the current event loop, which the app in
+    # test_query_plans uses, alone
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(run())
+    finally:
+        loop.close()
+
+
+def test_refresh_applies_changes_from_the_log(
+    database: Path, monkeypatch: pytest.MonkeyPatch
+):
+    index = TagIndex()
+    assert refresh(database, index) == [True]
+    assert index.watermark == 0
+
+    async def rebuild(_):
+        raise AssertionError("The index was rebuilt")
+
+    monkeypatch.setattr(index, "rebuild", rebuild)
+    write(database, link(BOOK, 1), link(BOOK, 2), link(OTHER, 2))
+    assert refresh(database, index) == [True]
+    assert index.tags_of(BOOK) == {1, 2}
+    assert [book.id for book in index.similar(OTHER)] == [BOOK]
+
+    write(
+        database,
+        ("UPDATE booktags SET book_id = ? WHERE tag_id = 1", (OTHER.hex,)),
+        ("DELETE FROM booktags WHERE book_id = ? AND tag_id = 2", (BOOK.hex,)),
+    )
+    assert refresh(database, index) == [True]
+    assert index.tags_of(BOOK) == frozenset()
+    assert index.tags_of(OTHER) == {1, 2}
+    assert index.watermark == 5
+
+    assert refresh(database, index) == [False]
+
+
+def test_refresh_rebuilds_past_the_log(database: Path, monkeypatch: pytest.MonkeyPatch):
+    index = TagIndex()
+    refresh(database, index)
+    write(
+        database,
+        link(BOOK, 1),
+        link(OTHER, 2),
+        # As if older than the versions kept
+        ("DELETE FROM booktagchange WHERE version = 1", ()),
+    )
+
+    rebuilt = []
+    rebuild = index.rebuild
+
+    async def record(db):
+        rebuilt.append(True)
+        await rebuild(db)
+
+    monkeypatch.setattr(index, "rebuild", record)
+    assert refresh(database, index) == [True]
+    assert rebuilt == [True]
+    assert index.tags_of(BOOK) == {1}
+    assert index.watermark == 2
+
+
+def test_advance_skips_only_its_own_writes(database: Path):
+    index = TagIndex()
+    refresh(database, index)
+
+    # This worker's write, from version 0 to 2
+    write(database, link(BOOK, 1), link(BOOK, 2))
+    index.set_tags(BOOK, [1, 2])
+    index.advance(2, changes=2)
+    assert index.watermark == 2
+
+    # Another worker's write came first, so it is left to refresh()
+    write(database, link(OTHER, 1), link(BOOK, 3))
+    index.set_tags(BOOK, [1, 2, 3])
+    index.advance(4, changes=1)
+    assert index.watermark == 2
+
+    refresh(database, index)
+    assert index.tags_of(OTHER) == {1}
+    assert index.watermark == 4
@@ -0,0 +1,250 @@
+from __future__ import annotations
+
+import asyncio
+import math
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Mapping, MutableMapping, Optional
+
+import orjson
+
+from .metrics import metrics
+
+Scope = MutableMapping[str, Any]
+Message = MutableMapping[str, Any]
+Receive = Callable[[], Awaitable[Message]]
+Send = Callable[[Message], Awaitable[None]]
+ASGIApp = Callable[[Scope, Receive, Send], Awaitable[None]]
+
+READ_METHODS = frozenset({"GET", "HEAD", "OPTIONS"})
+
+# Always admitted, so that the server can still be observed while shedding
+EXEMPT_PATHS = frozenset({"/metrics", "/docs", "/openapi.json"})
+
+# How much each new request time sample moves the average
+SERVICE_TIME_WEIGHT = 0.1
+
+admitted = metrics.counter(
+    "kaede_admission_admitted_total", "Requests admitted by admission control"
+)
+shed = metrics.counter(
+    "kaede_admission_shed_total", "Requests rejected by admission control"
+)
+active = metrics.gauge(
+    "kaede_admission_active", "Requests currently admitted, per route class"
+)
+queued = metrics.gauge(
+    "kaede_admission_queued", "Requests waiting to be admitted, per route class"
+)
+waited = metrics.counter(
+    "kaede_admission_wait_seconds_total",
+    "Time admitted requests spent waiting in the queue",
+)
+
+
+class OverloadedError(Exception):
+    """
+    Raised when a request cannot be admitted in time.
+    """
+
+    def __init__(self, reason: str, retry_after: float):
+        self.reason = reason
+        self.retry_after = retry_after
+        super().__init__(f"Request shed ({reason}), retry after {retry_after:.1f}s")
+
+
+@dataclass(frozen=True)
+class RouteClass:
+    name: str
+    # The number of requests handled at the same time
+    limit: int
+    # The number of requests that may wait for a slot
+    queue: int
+    # The longest a request may wait for a slot, in seconds
+    timeout: float
+
+
+class AdmissionQueue:
+    """
+    A FIFO semaphore with a bounded number of waiters and a wait deadline.
+
+    The average time requests hold a slot is tracked, so that a request that
+    would not be admitted before its deadline is rejected right away instead
+    of waiting for the deadline to pass.
+    """
+
+    def __init__(self, route_class: RouteClass):
+        self.route_class = route_class
+        self.active = 0
+        self.service_time: Optional[float] = None
+        self._waiters: deque[asyncio.Future[None]] = deque()
+
+    def expected_wait(self, position: int) -> float:
+        if self.service_time is None:
+            return 0.0
+        return (position // self.route_class.limit + 1) * self.service_time
+
+    async def acquire(self) -> None:
+        route_class = self.route_class
+        if self.active < route_class.limit and not self._waiters:
+            self.active += 1
+            return
+
+        position = len(self._waiters)
+        if position >= route_class.queue:
+            raise OverloadedError("queue_full", self.expected_wait(position))
+        wait = self.expected_wait(position)
+        if wait > route_class.timeout:
+            raise OverloadedError("deadline", wait)
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        queued.inc(route_class=route_class.name)
+        try:
+            await asyncio.wait_for(waiter, route_class.timeout)
+        except asyncio.TimeoutError:
+            raise OverloadedError("timeout", self.expected_wait(len(self._waiters)))
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as the request was cancelled
+                self.release()
+            raise
+        finally:
+            queued.dec(route_class=route_class.name)
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+    def release(self, service_time: Optional[float] = None) -> None:
+        if service_time is not None:
+            self.service_time = (
+                service_time
+                if self.service_time is None
+                else self.service_time
+                + SERVICE_TIME_WEIGHT * (service_time - self.service_time)
+            )
+
+        # Hand the slot straight to the next waiter, so that it cannot be
+        # taken by a request that arrived later
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+
+def classify(scope: Scope) -> Optional[str]:
+    """
+    This function returns the route class of a request, or None if it is
+    exempt from admission control.
+    """
+    path: str = scope["path"]
+    if path in EXEMPT_PATHS:
+        return None
+    if path in ("/login", "/register"):
+        return "auth"
+    # Batch gets are reads sent as POST, as their IDs do not fit in a URL
+    if scope["method"] in READ_METHODS or path.endswith(":batchGet"):
+        return "reads"
+    if path == "/assets":
+        return "uploads"
+    return "writes"
+
+
+DEFAULT_ROUTE_CLASSES = (
+    # Password hashing is CPU bound, so few logins run at once
+    RouteClass("auth", limit=2, queue=16, timeout=2.0),
+    # Writes serialize on SQLite's write lock anyway
+    RouteClass("writes", limit=4, queue=64, timeout=1.0),
+    RouteClass("reads", limit=64, queue=256, timeout=0.5),
+    RouteClass("uploads", limit=2, queue=8, timeout=5.0),
+)
+
+
+def load_route_classes(
+    config: Mapping[str, Mapping[str, Any]],
+) -> dict[str, RouteClass]:
+    """
+    This function returns the default route classes, with their settings
+    overridden by the given config.
+    """
+    route_classes = {}
+    for route_class in DEFAULT_ROUTE_CLASSES:
+        overrides = config.get(route_class.name, {})
+        route_classes[route_class.name] = RouteClass(
+            name=route_class.name,
+            limit=overrides.get("limit", route_class.limit),
+            queue=overrides.get("queue", route_class.queue),
+            timeout=overrides.get("timeout", route_class.timeout),
+        )
+    return route_classes
+
+
+class AdmissionMiddleware:
+    """
+    Limits how many requests of each route class a worker handles at once.
+
+    Requests over the limit wait in a bounded queue. Those that cannot be
+    admitted before the class's deadline are rejected with a ``503`` and a
+    ``Retry-After`` header, so that a burst of one kind of request, e.g.
+    writes, fails fast instead of slowing down every other request.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        *,
+        route_classes: Mapping[str, RouteClass],
+        classify: Callable[[Scope], Optional[str]] = classify,
+    ):
+        self.app = app
+        self.classify = classify
+        self.queues = {
+            name: AdmissionQueue(route_class)
+            for name, route_class in route_classes.items()
+        }
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        name = self.classify(scope)
+        queue = self.queues.get(name) if name is not None else None
+        if queue is None:
+            return await self.app(scope, receive, send)
+
+        arrived = time.monotonic()
+        try:
+            await queue.acquire()
+        except OverloadedError as e:
+            shed.inc(route_class=queue.route_class.name, reason=e.reason)
+            return await self.reject(send, e)
+
+        started = time.monotonic()
+        admitted.inc(route_class=queue.route_class.name)
+        waited.inc(started - arrived, route_class=queue.route_class.name)
+        active.inc(route_class=queue.route_class.name)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            active.dec(route_class=queue.route_class.name)
+            queue.release(time.monotonic() - started)
+
+    async def reject(self, send: Send, error: OverloadedError) -> None:
+        body = orjson.dumps({"detail": "Server is overloaded, try again later"})
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 503,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode()),
+                    (
+                        b"retry-after",
+                        str(max(1, math.ceil(error.retry_after))).encode(),
+                    ),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
@@ -1,6 +1,291 @@
 import base64
 import hashlib
+import time
+import weakref
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Iterable, NamedTuple, Optional
+
+from db.models import (
+    Asset,
+    Author,
+    Book,
+    CommentMessage,
+    User,
+    UserPhoto,
+)
+from sqlalchemy import (
+    ColumnElement,
+    String,
+    exists,
+    func,
+    literal,
+    literal_column,
+    tuple_,
+    type_coerce,
+)
+from sqlalchemy.orm import Mapped
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.expression import UnaryExpression
+from sqlmodel import col, delete, select
+
+from .jobs import job_handler
+from .metrics import metrics
+from .types import Database
+
+# Unreferenced assets are kept for this long, so that clients can upload an
+# asset before saving whatever refers to it.
+ASSET_GRACE_PERIOD = timedelta(hours=1)
+
+SWEEP_BATCH_SIZE = 100
+SWEEP_TIME_BUDGET = 0.5  # seconds
+
+# How long a worker may serve an asset that another worker deleted
+ASSET_CACHE_TTL = 60.0  # seconds
+
+assets_swept = metrics.counter(
+    "kaede_assets_swept_total", "Unreferenced assets deleted by the sweeper"
+)
+assets_scanned = metrics.counter(
+    "kaede_assets_scanned_total", "Assets checked for references by the sweeper"
+)
+asset_sweeps = metrics.counter(
+    "kaede_asset_sweeps_total", "Runs of the unreferenced asset sweeper"
+)
+
+asset_cache_hits = metrics.counter("kaede_asset_cache_hits_total", "Asset cache hits")
+asset_cache_misses = metrics.counter(
+    "kaede_asset_cache_misses_total", "Asset cache misses"
+)
+asset_cache_evictions = metrics.counter(
+    "kaede_asset_cache_evictions_total", "Assets evicted from the asset cache"
+)
+asset_cache_bytes = metrics.gauge(
+    "kaede_asset_cache_bytes", "Bytes of asset data held by the asset cache"
+)
 
 
 def hash_bytes(data: bytes) -> str:
     return base64.urlsafe_b64encode(hashlib.sha256(data).digest()).decode("utf-8")
+
+
+class CachedAsset(NamedTuple):
+    content_type: str
+    alt: Optional[str]
+    data: bytes
+
+
+# Every asset cache of this process, so that deleted assets can be evicted
+_asset_caches: weakref.WeakSet["AssetCache"] = weakref.WeakSet()
+
+
+class AssetCache:
+    """
+    A per-worker LRU cache of small assets, bounded by the total size of
+    their data.
+
+    Assets are addressed by the hash of their data, so a cached asset never
+    changes, but it can be deleted. Deleted assets are evicted from the
+    caches of the worker that deleted them, and expire from the caches of
+    other workers after the TTL.
+    """
+
+    def __init__(
+        self, *, max_bytes: int, max_item_bytes: int, ttl: float = ASSET_CACHE_TTL
+    ):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self.ttl = ttl
+        self.size = 0
+        # Assets along with when they expire, least recently used first
+        self._assets: OrderedDict[str, tuple[CachedAsset, float]] = OrderedDict()
+        _asset_caches.add(self)
+
+    def __len__(self) -> int:
+        return len(self._assets)
+
+    def get(self, hash: str) -> Optional[CachedAsset]:
+        entry = self._assets.get(hash)
+        if entry is not None and entry[1] <= time.monotonic():
+            self.discard(hash)
+            entry = None
+        if entry is None:
+            asset_cache_misses.inc()
+            return None
+
+        self._assets.move_to_end(hash)
+        asset_cache_hits.inc()
+        return entry[0]
+
+    def fits(self, size: int) -> bool:
+        return size <= self.max_item_bytes
+
+    def put(self, hash: str, asset: CachedAsset) -> None:
+        """
+        This function caches an asset, evicting the least recently used ones
+        to stay within the byte budget. Assets over the size cap are ignored.
+        """
+        if not self.fits(len(asset.data)) or hash in self._assets:
+            return
+
+        self._assets[hash] = (asset, time.monotonic() + self.ttl)
+        self.size += len(asset.data)
+        while self.size > self.max_bytes:
+            _, (evicted, _) = self._assets.popitem(last=False)
+            self.size -= len(evicted.data)
+            asset_cache_evictions.inc()
+        asset_cache_bytes.set(self.size)
+
+    def discard(self, hash: str) -> None:
+        entry = self._assets.pop(hash, None)
+        if entry is not None:
+            self.size -= len(entry[0].data)
+            asset_cache_bytes.set(self.size)
+
+
+def forget_assets(hashes: Iterable[str]) -> None:
+    """
+    This function evicts deleted assets from the asset caches of this
+    process.
+    """
+    hashes = list(hashes)
+    for cache in _asset_caches:
+        for hash in hashes:
+            cache.discard(hash)
+
+
+def is_referenced(hash: Mapped[str]) -> ColumnElement[bool]:
+    """
+    This function returns a condition that holds if any row refers to the
+    given asset hash. Every column checked here is indexed, so the condition
+    costs one index probe per table.
+    """
+    # For ix_commentmessage_asset_hash to be used, the path must be inlined
+    # rather than bound, and the hash compared without its TEXT affinity
+    # (unary +), as json_extract() has none.
+    comment_asset_hash = func.json_extract(
+        col(CommentMessage.content), literal_column("'$.asset_hash'")
+    )
+    # type_coerce() renders the hash as is, as the expression that
+    # UnaryExpression needs
+    bare_hash = UnaryExpression(
+        type_coerce(hash, String()), operator=operators.custom_op("+")
+    )
+    return (
+        exists().where(col(User.avatar_hash) == hash)
+        | exists().where(col(Author.avatar_hash) == hash)
+        | exists().where(col(Book.image_hash) == hash)
+        | exists().where(col(UserPhoto.photo_hash) == hash)
+        | exists().select_from(CommentMessage).where(comment_asset_hash == bare_hash)
+    )
+
+
+@job_handler("delete-unreferenced-assets")
+async def delete_unreferenced_assets(db: Database, payload: dict[str, Any]) -> None:
+    """
+    This job deletes the given assets right away if nothing refers to them
+    anymore, e.g. photos a user just removed, instead of leaving them to the
+    sweeper. Assets within the grace period are left to the sweeper.
+    """
+    cutoff = datetime.now(timezone.utc) - ASSET_GRACE_PERIOD
+    deleted = (
+        (
+            await db.execute(
+                delete(Asset)
+                .where(
+                    col(Asset.hash).in_(payload["hashes"]),
+                    col(Asset.created_at) <= cutoff,
+                    ~is_referenced(col(Asset.hash)),
+                )
+                .returning(col(Asset.hash))
+            )
+        )
+        .scalars()
+        .all()
+    )
+    # The job commits right after this, and the TTL covers a request caching
+    # one of these assets in between
+    forget_assets(deleted)
+    assets_swept.inc(len(deleted))
+
+
+class AssetSweeper:
+    """
+    Deletes assets that nothing refers to anymore, oldest first.
+
+    Each run walks the assets older than the grace period in batches, and
+    resumes where the previous run stopped once its time budget is spent.
+    Assets that are still referenced are therefore only checked once per pass
+    over the table, instead of on every run. Each batch is committed on its
+    own, and the reference check runs in the same statement as the delete, so
+    an asset cannot become referenced in between.
+    """
+
+    def __init__(
+        self,
+        *,
+        grace_period: timedelta = ASSET_GRACE_PERIOD,
+        batch_size: int = SWEEP_BATCH_SIZE,
+        time_budget: float = SWEEP_TIME_BUDGET,
+    ):
+        self.grace_period = grace_period
+        self.batch_size = batch_size
+        self.time_budget = time_budget
+        # The (created_at, hash) of the last asset checked in this pass
+        self.position: Optional[tuple[datetime, str]] = None
+
+    async def sweep(self, db: Database) -> int:
+        """
+        This function runs the sweeper until it reaches the end of the
+        table or spends its time budget, and returns the number of deleted
+        assets.
+        """
+        deadline = time.monotonic() + self.time_budget
+        cutoff = datetime.now(timezone.utc) - self.grace_period
+        swept = 0
+
+        while True:
+            candidates = (
+                select(Asset.created_at, Asset.hash)
+                .where(Asset.created_at <= cutoff)
+                .order_by(col(Asset.created_at), col(Asset.hash))
+                .limit(self.batch_size)
+            )
+            if self.position is not None:
+                candidates = candidates.where(
+                    tuple_(col(Asset.created_at), col(Asset.hash))
+                    > tuple_(*(literal(value) for value in self.position))
+                )
+            batch = (await db.exec(candidates)).all()
+            if batch:
+                deleted = (
+                    (
+                        await db.execute(
+                            delete(Asset)
+                            .where(
+                                col(Asset.hash).in_([hash for _, hash in batch]),
+                                ~is_referenced(col(Asset.hash)),
+                            )
+                            .returning(col(Asset.hash))
+                        )
+                    )
+                    .scalars()
+                    .all()
+                )
+                await db.commit()
+                forget_assets(deleted)
+                swept += len(deleted)
+                assets_scanned.inc(len(batch))
+
+            if len(batch) < self.batch_size:
+                # Reached the end, so start over on the next run
+                self.position = None
+                break
+
+            self.position = batch[-1]
+            if time.monotonic() >= deadline:
+                break
+
+        asset_sweeps.inc()
+        assets_swept.inc(swept)
+        return swept
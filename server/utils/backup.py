@@ -0,0 +1,250 @@
+from __future__ import annotations
+
+import asyncio
+import fcntl
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, Optional
+
+import sqlalchemy
+
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Snapshots are taken with SQLite's online backup API, which copies the
+# database a few pages at a time. The copy runs in a thread and sleeps between
+# steps, so that it neither blocks the event loop nor saturates the disk.
+#
+# In WAL mode, which the app's connections switch the database to, the source
+# connection holds a read transaction for the whole copy. Readers do not block
+# writers in WAL mode, so the snapshot is of a single point in time while
+# writers carry on. In any other mode a read transaction would block writers,
+# so none is held between steps, and the copy restarts whenever the database
+# is written to meanwhile.
+#
+# Each snapshot is written to a temporary file, checked, and renamed into
+# place along with a checksum file in the format of `sha256sum`. A lock file
+# in the backup directory ensures only one process takes snapshots at a time.
+
+SNAPSHOT_PREFIX = "kaede-"
+SNAPSHOT_SUFFIX = ".db"
+CHECKSUM_SUFFIX = ".sha256"
+LOCK_NAME = ".lock"
+
+BACKUP_PAGES = 256
+BACKUP_STEP_DELAY = 0.01  # seconds
+
+backups = metrics.counter("kaede_backups_total", "Database backups, by result")
+backup_progress = metrics.gauge(
+    "kaede_backup_progress", "Fraction of the database copied by the running backup"
+)
+backup_duration = metrics.gauge(
+    "kaede_backup_duration_seconds", "Time taken by the last successful backup"
+)
+backup_size = metrics.gauge(
+    "kaede_backup_size_bytes", "Size of the last successful backup"
+)
+backup_last_success = metrics.gauge(
+    "kaede_backup_last_success_timestamp_seconds",
+    "Unix time of the last successful backup",
+)
+
+
+class BackupError(Exception):
+    """
+    Raised when a snapshot fails its integrity check.
+    """
+
+
+def database_path(url: str) -> Path:
+    """
+    This function returns the path of the SQLite database a URL points to.
+    """
+    database = sqlalchemy.make_url(url).database
+    if not database or database == ":memory:":
+        raise ValueError(f"{url} does not point to a database file")
+    return Path(database)
+
+
+def file_checksum(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1 << 20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def verify_snapshot(path: Path) -> bool:
+    """
+    This function returns whether a snapshot matches its checksum file.
+    """
+    checksum_path = path.with_name(path.name + CHECKSUM_SUFFIX)
+    try:
+        expected = checksum_path.read_text().split()[0]
+    except (FileNotFoundError, IndexError):
+        return False
+    return file_checksum(path) == expected
+
+
+class BackupRunner:
+    """
+    Takes consistent snapshots of the database into a directory, keeping
+    only the most recent ones.
+    """
+
+    def __init__(
+        self,
+        database: Path,
+        directory: Path,
+        *,
+        keep: int = 7,
+        pages: int = BACKUP_PAGES,
+        step_delay: float = BACKUP_STEP_DELAY,
+    ):
+        self.database = database
+        self.directory = directory
+        self.keep = keep
+        self.pages = pages
+        self.step_delay = step_delay
+
+    def snapshots(self) -> list[Path]:
+        """
+        This function returns the snapshots in the directory, oldest first.
+        """
+        # Names sort by time
+        return sorted(self.directory.glob(f"{SNAPSHOT_PREFIX}*{SNAPSHOT_SUFFIX}"))
+
+    def due(self, interval: float) -> bool:
+        """
+        This function returns whether the newest snapshot is older than the
+        interval, in seconds.
+        """
+        snapshots = self.snapshots()
+        if not snapshots:
+            return True
+        return time.time() - snapshots[-1].stat().st_mtime >= interval
+
+    async def run(self, interval: Optional[float] = None) -> Optional[Path]:
+        """
+        This function takes a snapshot in a thread. See backup().
+        """
+        return await asyncio.to_thread(self.backup, interval)
+
+    def backup(self, interval: Optional[float] = None) -> Optional[Path]:
+        """
+        This function takes a snapshot and returns its path. Returns None
+        without taking one if another process is taking a snapshot, or if an
+        interval is given and the newest snapshot is younger than it.
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with self._lock() as locked:
+            if not locked or (interval is not None and not self.due(interval)):
+                backups.inc(result="skipped")
+                return None
+
+            try:
+                return self._backup()
+            except BaseException:
+                backups.inc(result="failed")
+                raise
+            finally:
+                backup_progress.set(0)
+
+    def _backup(self) -> Path:
+        started = time.monotonic()
+        name = time.strftime(
+            f"{SNAPSHOT_PREFIX}%Y%m%dT%H%M%SZ{SNAPSHOT_SUFFIX}", time.gmtime()
+        )
+        path = self.directory / name
+        partial = path.with_name(name + ".tmp")
+        # Left behind by a backup that crashed
+        for stale in self.directory.glob("*.tmp"):
+            stale.unlink(missing_ok=True)
+
+        def progress(_: int, remaining: int, total: int) -> None:
+            backup_progress.set(1 - remaining / total if total else 1)
+            time.sleep(self.step_delay)
+
+        source = sqlite3.connect(self.database, isolation_level=None, timeout=30)
+        target = sqlite3.connect(partial)
+        try:
+            (mode,) = source.execute("PRAGMA journal_mode").fetchone()
+            pinned = mode.lower() in ("wal", "wal2")
+            if pinned:
+                # Pin the snapshot the backup reads from
+                source.execute("BEGIN")
+                source.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchall()
+            else:
+                logger.warning(
+                    "The database is in %s mode, so the backup restarts whenever "
+                    "it is written to",
+                    mode,
+                )
+            source.backup(target, pages=self.pages, progress=progress)
+            if pinned:
+                source.execute("COMMIT")
+
+            (result,) = target.execute("PRAGMA quick_check").fetchone()
+            if result != "ok":
+                raise BackupError(f"Snapshot {name} failed its check: {result}")
+            # The copy inherits the journal mode of the database, and WAL would
+            # leave -wal and -shm files next to a snapshot that is opened
+            target.execute("PRAGMA journal_mode=DELETE")
+        except BaseException:
+            target.close()
+            partial.unlink(missing_ok=True)
+            raise
+        finally:
+            source.close()
+        target.close()
+
+        with open(partial, "rb") as f:
+            os.fsync(f.fileno())
+        checksum = file_checksum(partial)
+        checksum_path = path.with_name(name + CHECKSUM_SUFFIX)
+        checksum_path.write_text(f"{checksum}  {name}\n")
+        os.replace(partial, path)
+
+        self._rotate()
+
+        duration = time.monotonic() - started
+        size = path.stat().st_size
+        backups.inc(result="ok")
+        backup_duration.set(duration)
+        backup_size.set(size)
+        backup_last_success.set(time.time())
+        logger.info(
+            "Backed up the database to %s (%d bytes, %.1fs)", path, size, duration
+        )
+        return path
+
+    def _rotate(self) -> None:
+        snapshots = self.snapshots()
+        for old in snapshots[: max(0, len(snapshots) - self.keep)]:
+            old.unlink(missing_ok=True)
+            old.with_name(old.name + CHECKSUM_SUFFIX).unlink(missing_ok=True)
+
+    @contextmanager
+    def _lock(self) -> Iterator[bool]:
+        # flock locks belong to the open file, so this also excludes other
+        # threads of the same process
+        fd = os.open(self.directory / LOCK_NAME, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+
+            try:
+                yield True
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
@@ -0,0 +1,40 @@
+from __future__ import annotations
+
+from typing import Generic, Hashable, Mapping, Optional, TypeVar
+
+from pydantic import BaseModel, Field
+
+K = TypeVar("K", bound=Hashable)
+T = TypeVar("T")
+
+BATCH_LIMIT = 100
+
+
+class BatchGetRequest(BaseModel, Generic[K]):
+    """
+    A request for up to ``BATCH_LIMIT`` items by ID.
+    """
+
+    ids: list[K] = Field(min_length=1, max_length=BATCH_LIMIT)
+
+
+class BatchGetResponse(BaseModel, Generic[K, T]):
+    """
+    The requested items, in request order. Items that do not exist are
+    returned as null and their IDs are listed in ``missing``.
+    """
+
+    data: list[Optional[T]]
+    missing: list[K]
+
+
+def in_request_order(ids: list[K], found: Mapping[K, T]) -> BatchGetResponse[K, T]:
+    """
+    This function orders the items fetched for a batch request, keyed by ID,
+    to match the requested IDs.
+    """
+    missing = [id for id in dict.fromkeys(ids) if id not in found]
+    return BatchGetResponse(
+        data=[found.get(id) for id in ids],
+        missing=missing,
+    )
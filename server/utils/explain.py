@@ -0,0 +1,140 @@
+from __future__ import annotations
+
+import logging
+import re
+from typing import Any, Iterable, Optional
+
+import sqlalchemy
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+_SCAN = re.compile(r"^SCAN (\w+)(?: AS \w+)?( USING (?:COVERING )?INDEX \w+)?$")
+_LIMIT = re.compile(r"\bLIMIT\b", re.IGNORECASE)
+_EXPLAINABLE = ("SELECT", "UPDATE", "DELETE", "INSERT", "WITH")
+
+
+class QueryPlanError(Exception):
+    """
+    Raised when a statement's query plan performs a full scan of a table that
+    is expected to grow large.
+    """
+
+    def __init__(self, statement: str, scans: list[str]):
+        self.statement = statement
+        self.scans = scans
+        super().__init__(
+            f"Full table scan of {', '.join(scans)} in query plan for: {statement}"
+        )
+
+
+def full_scans(
+    plan: Iterable[str],
+    tables: Optional[set[str]] = None,
+    *,
+    limited: bool = False,
+) -> list[str]:
+    """
+    This function returns the tables that an ``EXPLAIN QUERY PLAN`` output
+    scans in full. Scans that walk an index in order (``SCAN book USING INDEX
+    ...``) are only allowed in a statement with a ``LIMIT``, which stops them
+    early. Without one they read the whole index, e.g. to count rows.
+    """
+    scanned = []
+    for detail in plan:
+        match = _SCAN.match(detail.strip())
+        if match is None or (match.group(2) and limited):
+            continue
+
+        table = match.group(1)
+        if tables is None or table in tables:
+            scanned.append(table)
+    return scanned
+
+
+class QueryPlanGuard:
+    """
+    Runs ``EXPLAIN QUERY PLAN`` on every statement an engine executes and
+    reports full scans of the watched tables.
+
+    This is a development aid meant to catch route queries that regress into
+    full scans, e.g. after an index or query change. With ``strict`` set, the
+    offending statement fails with a ``QueryPlanError``, otherwise a warning is
+    logged. Plans are cached per statement, so each distinct query is only
+    explained once.
+
+    Statements that scan on purpose, e.g. background rebuilds, can opt out
+    with ``.execution_options(allow_full_scan=True)``.
+    """
+
+    def __init__(
+        self,
+        *,
+        tables: Optional[Iterable[str]] = None,
+        ignore: Iterable[str] = (),
+        strict: bool = False,
+    ):
+        self.tables = set(tables) if tables is not None else None
+        self.ignore = set(ignore)
+        self.strict = strict
+        self.statements: dict[str, list[str]] = {}
+        self.violations: dict[str, list[str]] = {}
+
+    def attach(self, engine: sqlalchemy.Engine) -> None:
+        event.listen(engine, "before_cursor_execute", self._on_execute)
+
+    def detach(self, engine: sqlalchemy.Engine) -> None:
+        event.remove(engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(
+        self,
+        conn: sqlalchemy.Connection,
+        cursor: Any,
+        statement: str,
+        parameters: Any,
+        context: Any,
+        executemany: bool,
+    ) -> None:
+        if context is not None and context.execution_options.get("allow_full_scan"):
+            return
+
+        if statement in self.statements:
+            scans = self.violations.get(statement)
+        else:
+            if not statement.lstrip().upper().startswith(_EXPLAINABLE):
+                return
+
+            # Explained with the first parameter set. Rows inserted with
+            # insertmanyvalues are flagged as executemany, but each comes with
+            # a single parameter set.
+            if (
+                executemany
+                and parameters
+                and isinstance(parameters[0], (list, tuple, dict))
+            ):
+                parameters = parameters[0]
+
+            explain = conn.connection.cursor()
+            try:
+                explain.execute(f"EXPLAIN QUERY PLAN {statement}", parameters)
+                plan = [row[-1] for row in explain.fetchall()]
+            finally:
+                explain.close()
+
+            self.statements[statement] = plan
+            scans = [
+                table
+                for table in full_scans(
+                    plan, self.tables, limited=bool(_LIMIT.search(statement))
+                )
+                if table not in self.ignore
+            ]
+            if scans:
+                self.violations[statement] = scans
+
+        if not scans:
+            return
+
+        if self.strict:
+            raise QueryPlanError(statement, scans)
+        logger.warning("Full table scan of %s in: %s", ", ".join(scans), statement)
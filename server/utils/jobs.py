@@ -0,0 +1,254 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import random
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Optional
+
+from db.models import Job
+from sqlmodel import col, delete, select, update
+
+from .metrics import metrics
+from .types import Database
+
+logger = logging.getLogger(__name__)
+
+# Jobs are stored in the job table and run by a JobWorker in every process.
+#
+# A job is claimed by pushing its run_at past a lease, in the same UPDATE that
+# selects it, so that no two workers claim the same job. A finished job is
+# deleted. A failed job is scheduled again with an exponential backoff until
+# it runs out of attempts. A job whose worker died before finishing it is
+# claimed again once its lease expires, so jobs are run at least once and
+# handlers must be idempotent.
+
+JobHandler = Callable[[Database, dict[str, Any]], Awaitable[None]]
+
+JOB_LEASE = timedelta(minutes=5)
+JOB_BATCH_SIZE = 10
+JOB_POLL_INTERVAL = 1.0  # seconds
+RETRY_BASE_DELAY = 5.0  # seconds
+RETRY_MAX_DELAY = 3600.0  # seconds
+
+jobs_enqueued = metrics.counter("kaede_jobs_enqueued_total", "Jobs enqueued")
+jobs_completed = metrics.counter("kaede_jobs_completed_total", "Jobs completed")
+jobs_retried = metrics.counter(
+    "kaede_jobs_retried_total", "Failed job attempts that will be retried"
+)
+jobs_failed = metrics.counter(
+    "kaede_jobs_failed_total", "Jobs that failed on their last attempt"
+)
+jobs_running = metrics.gauge("kaede_jobs_running", "Jobs currently running")
+
+handlers: dict[str, JobHandler] = {}
+
+
+def job_handler(kind: str) -> Callable[[JobHandler], JobHandler]:
+    """
+    This function registers the decorated coroutine function as the handler
+    of a kind of job. Handlers get their own database session and the job's
+    payload, and are committed after they return.
+    """
+
+    def register(handler: JobHandler) -> JobHandler:
+        if kind in handlers:
+            raise ValueError(f"A handler for {kind} jobs is already registered")
+        handlers[kind] = handler
+        return handler
+
+    return register
+
+
+def enqueue(
+    db: Database,
+    kind: str,
+    payload: dict[str, Any],
+    *,
+    delay: Optional[timedelta] = None,
+    max_attempts: int = 5,
+) -> Job:
+    """
+    This function adds a job to the session. It is only enqueued once the
+    session commits, so it is never run for a request that failed.
+    """
+    now = datetime.now(timezone.utc)
+    job = Job(
+        kind=kind,
+        payload=payload,
+        run_at=now + delay if delay else now,
+        max_attempts=max_attempts,
+    )
+    db.add(job)
+    jobs_enqueued.inc(kind=kind)
+    return job
+
+
+def retry_delay(attempts: int) -> float:
+    """
+    This function returns how long to wait before the next attempt, with
+    full jitter so that failing jobs do not retry in lockstep.
+    """
+    delay = min(RETRY_BASE_DELAY * 2 ** (attempts - 1), RETRY_MAX_DELAY)
+    return random.uniform(delay / 2, delay)
+
+
+class JobWorker:
+    """
+    Claims due jobs in batches and runs them in the background.
+    """
+
+    def __init__(
+        self,
+        session: Callable[[], Database],
+        *,
+        concurrency: int = 4,
+        batch_size: int = JOB_BATCH_SIZE,
+        poll_interval: float = JOB_POLL_INTERVAL,
+        lease: timedelta = JOB_LEASE,
+    ):
+        self.session = session
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.concurrency = concurrency
+        self._running: set[asyncio.Task[None]] = set()
+        self._task: Optional[asyncio.Task[None]] = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="job-worker")
+
+    async def stop(self, timeout: float = 5.0) -> None:
+        """
+        This function stops claiming jobs and gives running jobs some time to
+        finish. Jobs still running after that are cancelled, and are claimed
+        again once their lease expires.
+        """
+        if self._task is None:
+            return
+
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+        if self._running:
+            _, pending = await asyncio.wait(self._running, timeout=timeout)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _run(self) -> None:
+        while True:
+            free = self.concurrency - len(self._running)
+            if free <= 0:
+                await asyncio.wait(self._running, return_when=asyncio.FIRST_COMPLETED)
+                continue
+
+            try:
+                claimed = await self.claim(min(free, self.batch_size))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Failed to claim jobs")
+                claimed = 0
+
+            # Claim again right away while there is a backlog
+            if claimed < free:
+                await asyncio.sleep(self.poll_interval)
+
+    async def claim(self, limit: int) -> int:
+        """
+        This function claims up to limit due jobs in a single statement,
+        starts running them and returns how many it claimed.
+        """
+        now = datetime.now(timezone.utc)
+        due = (
+            select(Job.id)
+            .where(col(Job.run_at) <= now)
+            .order_by(col(Job.run_at))
+            .limit(limit)
+        )
+        async with self.session() as db:
+            # Polling an empty queue then only reads, rather than taking the
+            # write lock that other writers wait on
+            if (await db.exec(due.limit(1))).first() is None:
+                return 0
+
+            jobs = (
+                await db.execute(
+                    update(Job)
+                    .where(col(Job.id).in_(due))
+                    .values(run_at=now + self.lease, attempts=col(Job.attempts) + 1)
+                    .returning(
+                        col(Job.id),
+                        col(Job.kind),
+                        col(Job.payload),
+                        col(Job.attempts),
+                        col(Job.max_attempts),
+                    )
+                )
+            ).all()
+            await db.commit()
+
+        for job in jobs:
+            task = asyncio.create_task(self._execute(*job), name=f"job-{job.id}")
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+        return len(jobs)
+
+    async def _execute(
+        self,
+        id: int,
+        kind: str,
+        payload: dict[str, Any],
+        attempts: int,
+        max_attempts: int,
+    ) -> None:
+        jobs_running.inc()
+        try:
+            handler = handlers.get(kind)
+            if handler is None:
+                raise LookupError(f"No handler is registered for {kind} jobs")
+
+            async with self.session() as db:
+                await handler(db, payload)
+                await db.execute(delete(Job).where(col(Job.id) == id))
+                await db.commit()
+            jobs_completed.inc(kind=kind)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception("Job %d (%s) failed on attempt %d", id, kind, attempts)
+            await self._fail(id, kind, attempts, max_attempts, e)
+        finally:
+            jobs_running.dec()
+
+    async def _fail(
+        self,
+        id: int,
+        kind: str,
+        attempts: int,
+        max_attempts: int,
+        error: Exception,
+    ) -> None:
+        if attempts < max_attempts:
+            run_at = datetime.now(timezone.utc) + timedelta(
+                seconds=retry_delay(attempts)
+            )
+            jobs_retried.inc(kind=kind)
+        else:
+            # Kept without a run_at for inspection
+            run_at = None
+            jobs_failed.inc(kind=kind)
+
+        async with self.session() as db:
+            await db.execute(
+                update(Job)
+                .where(col(Job.id) == id)
+                .values(run_at=run_at, last_error=repr(error))
+            )
+            await db.commit()
@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+from typing import Optional, TypeVar, Union
+
+Number = Union[int, float]
+LabelSet = tuple[tuple[str, str], ...]
+M = TypeVar("M", bound="Metric")
+
+
+def _labels(labels: dict[str, str]) -> LabelSet:
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels: LabelSet) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(f'{key}="{value}"' for key, value in labels)
+    return f"{{{pairs}}}"
+
+
+class Metric:
+    """
+    A named series of values keyed by label set.
+    Metrics are kept per process.
+    """
+
+    type: str
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self._values: dict[LabelSet, Number] = {}
+
+    def get(self, **labels: str) -> Number:
+        return self._values.get(_labels(labels), 0)
+
+    def render(self) -> list[str]:
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        for labels, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(labels)} {value}")
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: Number = 1, **labels: str) -> None:
+        key = _labels(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: Number, **labels: str) -> None:
+        self._values[_labels(labels)] = value
+
+    def inc(self, amount: Number = 1, **labels: str) -> None:
+        key = _labels(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: Number = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, Metric] = {}
+
+    def counter(self, name: str, description: str) -> Counter:
+        """
+        This function returns the counter with the given name, creating it if
+        needed.
+        """
+        return self._register(Counter, name, description)
+
+    def gauge(self, name: str, description: str) -> Gauge:
+        """
+        This function returns the gauge with the given name, creating it if
+        needed.
+        """
+        return self._register(Gauge, name, description)
+
+    def get(self, name: str) -> Optional[Metric]:
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        """
+        This function renders every metric in the Prometheus text format.
+        """
+        lines: list[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def _register(self, cls: type[M], name: str, description: str) -> M:
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = cls(name, description)
+        elif not isinstance(metric, cls):
+            raise TypeError(f"Metric {name} is already registered as a {metric.type}")
+        return metric
+
+
+metrics = Registry()
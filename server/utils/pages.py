@@ -1,12 +1,31 @@
 from __future__ import annotations
 
-from typing import Annotated, Any, Generic, Optional, Sequence, TypeVar
+import base64
+import binascii
+from datetime import datetime
+from typing import TYPE_CHECKING, Annotated, Any, Generic, Optional, Sequence, TypeVar
 
-from fastapi import Query
+import orjson
+from fastapi import HTTPException, Query, Response
 from fastapi_pagination.bases import AbstractPage, AbstractParams, RawParams
+from pydantic import BaseModel
+from sqlalchemy import literal, tuple_
+from sqlmodel import SQLModel, desc, func, select
+
+if TYPE_CHECKING:
+    from sqlalchemy import ColumnElement, Select
+
+    from .types import Database
 
 T = TypeVar("T")
 
+FieldsQuery = Annotated[
+    Optional[str],
+    Query(
+        description="Comma-separated list of fields to return. Defaults to all fields"
+    ),
+]
+
 
 class KaedeParams(AbstractParams):
     page: Annotated[int, Query(default=1, ge=1)]
@@ -45,3 +64,131 @@ class KaedePages(AbstractPage[T], Generic[T]):
             data=items,
             total=total,
         )
+
+
+class KaedeCursorParams(BaseModel):
+    cursor: Optional[str] = None
+    size: int = 50
+
+
+def cursor_params(
+    cursor: Annotated[Optional[str], Query()] = None,
+    size: Annotated[int, Query(ge=1, le=100)] = 50,
+) -> KaedeCursorParams:
+    """
+    This function parses keyset pagination parameters.
+    Use it as a FastAPI dependency.
+    """
+    return KaedeCursorParams(cursor=cursor, size=size)
+
+
+class KaedeCursorPage(BaseModel, Generic[T]):
+    data: list[T]
+    next_cursor: Optional[str] = None
+
+
+def select_fields(
+    model: type[SQLModel], fields: Optional[str], *, required: Sequence[str] = ()
+) -> list[ColumnElement]:
+    """
+    This function resolves a comma-separated ``fields`` parameter into the
+    model's columns, in table order. All columns are returned if no fields are
+    given, including when ``fields`` only holds separators. The ``required``
+    columns are always included.
+    """
+    columns = model.__table__.columns  # type: ignore
+    requested = {field.strip() for field in (fields or "").split(",") if field.strip()}
+    if not requested:
+        return list(columns)
+
+    unknown = requested - set(columns.keys())
+    if unknown:
+        raise HTTPException(
+            status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}"
+        )
+    requested.update(required)
+    return [column for column in columns if column.key in requested]
+
+
+def encode_cursor(values: Sequence[Any]) -> str:
+    return base64.urlsafe_b64encode(orjson.dumps(values)).decode("utf-8")
+
+
+def decode_cursor(cursor: str, keys: Sequence[ColumnElement]) -> list[Any]:
+    """
+    This function decodes a cursor back into values for the given key columns.
+    """
+    try:
+        values = orjson.loads(base64.urlsafe_b64decode(cursor))
+        if not isinstance(values, list) or len(values) != len(keys):
+            raise ValueError("cursor does not match the keys")
+
+        decoded = []
+        for key, value in zip(keys, values):
+            python_type = key.type.python_type
+            if issubclass(python_type, datetime):
+                decoded.append(datetime.fromisoformat(value))
+            else:
+                decoded.append(python_type(value))
+        return decoded
+    except (binascii.Error, orjson.JSONDecodeError, TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+async def paginate_rows(db: Database, query: Select, params: KaedeParams) -> Response:
+    """
+    This function paginates a query over plain columns and serializes the rows
+    straight to JSON, skipping per-row model validation. The body has the same
+    shape as a ``KaedePages``.
+    """
+    raw = params.to_raw_params()
+    connection = await db.connection()
+    # Counting every row is inherent to the total of offset pages
+    total = (
+        await connection.execute(
+            select(func.count())
+            .select_from(query.order_by(None).subquery())
+            .execution_options(allow_full_scan=True)
+        )
+    ).scalar_one()
+    rows = await connection.execute(query.limit(raw.limit).offset(raw.offset))
+    return Response(
+        orjson.dumps({"data": [dict(row) for row in rows.mappings()], "total": total}),
+        media_type="application/json",
+    )
+
+
+async def paginate_keyset(
+    db: Database,
+    query: Select,
+    keys: Sequence[ColumnElement],
+    params: KaedeCursorParams,
+    **extra: Any,
+) -> Response:
+    """
+    This function paginates a query over plain columns in descending order of
+    the given keys, which must be selected and should be covered by an index.
+    Rows are serialized straight to JSON like in ``paginate_rows``, in the
+    shape of a ``KaedeCursorPage``. Any extra keyword arguments are added to
+    the body.
+    """
+    if params.cursor:
+        values = decode_cursor(params.cursor, keys)
+        query = query.where(
+            tuple_(*keys)
+            < tuple_(*(literal(value, key.type) for key, value in zip(keys, values)))
+        )
+
+    query = query.order_by(*(desc(key) for key in keys)).limit(params.size + 1)
+    connection = await db.connection()
+    rows = [dict(row) for row in (await connection.execute(query)).mappings()]
+
+    next_cursor = None
+    if len(rows) > params.size:
+        rows = rows[: params.size]
+        next_cursor = encode_cursor([rows[-1][key.key] for key in keys])
+
+    return Response(
+        orjson.dumps({"data": rows, "next_cursor": next_cursor, **extra}),
+        media_type="application/json",
+    )
@@ -0,0 +1,148 @@
+from __future__ import annotations
+
+import math
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Sequence
+
+import orjson
+from db.models import Book, BookStats
+from sqlalchemy import bindparam
+from sqlalchemy.dialects.sqlite import insert
+from sqlmodel import case, col, func, select, update
+
+from .types import Database
+
+# Each collection adds a weight of 1 that halves every TRENDING_HALF_LIFE.
+# Rather than decaying every stored score over time, scores are kept as
+# log(sum(2 ^ ((collected_at - TRENDING_EPOCH) / TRENDING_HALF_LIFE))), i.e.
+# relative to a fixed epoch. Decaying all scores by the same factor does not
+# change their order, so rankings are a plain ORDER BY on the stored value,
+# and adding a collection is a single logaddexp() in SQL. Removing one
+# subtracts the weight it was added with, using logsubexp(), so that
+# collecting a book over and over does not raise its score.
+TRENDING_EPOCH = datetime(2025, 1, 1, tzinfo=timezone.utc)
+TRENDING_HALF_LIFE = timedelta(days=3)
+
+TRENDING_LIMIT = 50
+
+
+def trending_offset(now: Optional[datetime] = None) -> float:
+    """
+    This function returns the log weight of a collection made at ``now``.
+    """
+    now = now or datetime.now(timezone.utc)
+    if now.tzinfo is None:
+        # As read back from SQLite
+        now = now.replace(tzinfo=timezone.utc)
+    return (
+        math.log(2)
+        * (now - TRENDING_EPOCH).total_seconds()
+        / TRENDING_HALF_LIFE.total_seconds()
+    )
+
+
+def trending_score(trending: Optional[float], now: Optional[datetime] = None) -> float:
+    """
+    This function converts a stored trending value into the decayed number of
+    collections as of ``now``.
+    """
+    if trending is None:
+        return 0.0
+    return math.exp(trending - trending_offset(now))
+
+
+async def record_collected(
+    db: Database, book_ids: Sequence[uuid.UUID], collected_at: datetime
+) -> None:
+    """
+    This function counts new collections of the given books, made at
+    collected_at. It must run in the same transaction that adds them.
+    """
+    if not book_ids:
+        return
+
+    offset = trending_offset(collected_at)
+    stmt = insert(BookStats).values(
+        [
+            {"book_id": book_id, "collections": 1, "trending": offset}
+            for book_id in book_ids
+        ]
+    )
+    await db.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[col(BookStats.book_id)],
+            set_={
+                "collections": col(BookStats.collections) + stmt.excluded.collections,
+                "trending": func.logaddexp(
+                    col(BookStats.trending), stmt.excluded.trending
+                ),
+            },
+        )
+    )
+
+
+async def record_uncollected(
+    db: Database, collections: Sequence[tuple[uuid.UUID, datetime]]
+) -> None:
+    """
+    This function counts removed collections, given as the book and when it
+    was collected, and takes their weight back out of the trending scores.
+    It must run in the same transaction that removes them.
+    """
+    if not collections:
+        return
+
+    table = BookStats.__table__  # type: ignore
+    await db.execute(
+        update(table)
+        .where(table.c.book_id == bindparam("removed_book_id"))
+        .values(
+            collections=func.max(table.c.collections - 1, 0),
+            # Subtracting leaves rounding errors behind, so the score of a
+            # book without collections is cleared outright
+            trending=case(
+                (table.c.collections <= 1, None),
+                else_=func.logsubexp(table.c.trending, bindparam("removed_weight")),
+            ),
+        ),
+        params=[
+            {
+                "removed_book_id": book_id,
+                "removed_weight": trending_offset(collected_at),
+            }
+            for book_id, collected_at in collections
+        ],
+    )
+
+
+class TrendingCache:
+    """
+    The most trending books, rendered to JSON ahead of time.
+
+    The listing is refreshed in the background, so serving it never touches
+    the database.
+    """
+
+    def __init__(self, limit: int = TRENDING_LIMIT):
+        self.limit = limit
+        self.body = orjson.dumps({"data": [], "refreshed_at": None})
+
+    async def refresh(self, db: Database) -> None:
+        now = datetime.now(timezone.utc)
+        rows = await db.exec(
+            select(Book, BookStats.collections, BookStats.trending)
+            .join(BookStats, col(BookStats.book_id) == Book.id)
+            .where(col(BookStats.trending).is_not(None))
+            .order_by(col(BookStats.trending).desc())
+            .limit(self.limit)
+        )
+        data = [
+            {
+                "book": book.model_dump(),
+                "collections": collections,
+                "score": trending_score(trending, now),
+            }
+            for book, collections, trending in rows
+        ]
+        self.body = orjson.dumps({"data": data, "refreshed_at": now})
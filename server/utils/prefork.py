@@ -0,0 +1,155 @@
+from __future__ import annotations
+
+import gc
+import logging
+import os
+import signal
+import socket
+import time
+from types import FrameType
+from typing import Callable, Optional
+
+import uvicorn
+from uvicorn.main import STARTUP_FAILURE
+
+logger = logging.getLogger("uvicorn.error")
+
+# A worker that exits sooner than this after being forked is counted as
+# failing on startup, e.g. because of bad config or an unreachable database
+MIN_UPTIME = 5.0  # seconds
+RESTART_BASE_DELAY = 0.5  # seconds
+RESTART_MAX_DELAY = 30.0  # seconds
+# The supervisor gives up after this many workers in a row fail on startup
+MAX_STARTUP_FAILURES = 5
+
+
+class PreforkSupervisor:
+    """
+    Runs uvicorn workers forked from an already imported and warmed app.
+
+    Unlike ``uvicorn.supervisors.Multiprocess``, which spawns fresh
+    interpreters that import the app again, forked workers start serving
+    immediately and share the parent's memory pages copy-on-write. Workers
+    that exit unexpectedly are replaced, with a growing delay while they keep
+    failing on startup. If too many fail in a row, the supervisor stops and
+    exits with uvicorn's startup failure status.
+    """
+
+    def __init__(
+        self,
+        config: uvicorn.Config,
+        *,
+        sockets: list[socket.socket],
+        workers: int,
+        on_fork: Optional[Callable[[], None]] = None,
+        max_startup_failures: int = MAX_STARTUP_FAILURES,
+    ):
+        self.config = config
+        self.sockets = sockets
+        self.workers = workers
+        self.on_fork = on_fork
+        self.max_startup_failures = max_startup_failures
+        # When each worker was forked
+        self.children: dict[int, float] = {}
+        self.startup_failures = 0
+        self.should_exit = False
+
+    def run(self) -> None:
+        # Objects created so far live for the whole process. Freezing them
+        # keeps the garbage collector from touching (and thus copying) their
+        # pages in every worker.
+        gc.collect()
+        gc.freeze()
+
+        signal.signal(signal.SIGINT, self.handle_exit)
+        signal.signal(signal.SIGTERM, self.handle_exit)
+
+        logger.info("Started prefork supervisor [%d]", os.getpid())
+        for _ in range(self.workers):
+            self.spawn()
+
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+
+            started = self.children.pop(pid, None)
+            if started is None or self.should_exit:
+                continue
+
+            code = os.waitstatus_to_exitcode(status)
+            if code == STARTUP_FAILURE or time.monotonic() - started < MIN_UPTIME:
+                self.startup_failures += 1
+            else:
+                self.startup_failures = 0
+
+            if self.startup_failures >= self.max_startup_failures:
+                logger.error(
+                    "%d workers in a row failed on startup, giving up",
+                    self.startup_failures,
+                )
+                self.handle_exit(signal.SIGTERM, None)
+                continue
+
+            delay = 0.0
+            if self.startup_failures:
+                delay = min(
+                    RESTART_BASE_DELAY * 2 ** (self.startup_failures - 1),
+                    RESTART_MAX_DELAY,
+                )
+            logger.warning(
+                "Worker [%d] exited with status %d, restarting in %.1fs",
+                pid,
+                code,
+                delay,
+            )
+            self.sleep(delay)
+            if not self.should_exit:
+                self.spawn()
+
+        logger.info("Stopping prefork supervisor [%d]", os.getpid())
+        if self.startup_failures >= self.max_startup_failures:
+            raise SystemExit(STARTUP_FAILURE)
+
+    def sleep(self, delay: float) -> None:
+        """
+        This function sleeps for the delay, but returns early on shutdown.
+        """
+        deadline = time.monotonic() + delay
+        while not self.should_exit and (remaining := deadline - time.monotonic()) > 0:
+            time.sleep(min(remaining, 0.1))
+
+    def spawn(self) -> None:
+        pid = os.fork()
+        if pid:
+            self.children[pid] = time.monotonic()
+            return
+
+        # Child process: uvicorn installs its own signal handlers in serve()
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        code = 0
+        try:
+            if self.on_fork is not None:
+                self.on_fork()
+            server = uvicorn.Server(self.config)
+            server.run(sockets=self.sockets)
+            if not server.started:
+                # e.g. the app's lifespan startup failed
+                code = STARTUP_FAILURE
+        except BaseException:
+            logger.exception("Worker [%d] crashed", os.getpid())
+            code = 1
+        finally:
+            os._exit(code)
+
+    def handle_exit(self, sig: int, frame: Optional[FrameType]) -> None:
+        self.should_exit = True
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
@@ -0,0 +1,254 @@
+from __future__ import annotations
+
+import asyncio
+import hmac
+import itertools
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from types import FrameType
+from typing import Any, Iterator, Optional
+
+from .admission import ASGIApp, Message, Receive, Scope, Send
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = b"x-kaede-profile"
+PROFILE_ID_HEADER = b"x-kaede-profile-id"
+
+SAMPLE_INTERVAL = 0.005  # seconds
+
+_UNSAFE = re.compile(r"[^A-Za-z0-9_.-]+")
+_sequence = itertools.count()
+
+profiles_captured = metrics.counter(
+    "kaede_profiles_captured_total", "Requests profiled by the profiling middleware"
+)
+
+
+def _label(frame: FrameType) -> str:
+    code = frame.f_code
+    name = getattr(code, "co_qualname", code.co_name)
+    return f"{name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _awaited_frames(awaitable: Any) -> Iterator[FrameType | str]:
+    """
+    This function follows a chain of awaits from the given coroutine down to
+    what it is ultimately waiting on, and yields the frames along the way.
+    The last item is a label for that awaitable if it has no frame, e.g. a
+    future waiting for a database result.
+    """
+    while awaitable is not None:
+        if isinstance(awaitable, asyncio.Task):
+            awaitable = awaitable.get_coro()
+            continue
+
+        frame = (
+            getattr(awaitable, "cr_frame", None)
+            or getattr(awaitable, "gi_frame", None)
+            or getattr(awaitable, "ag_frame", None)
+        )
+        if frame is None:
+            yield f"<awaiting {type(awaitable).__name__}>"
+            return
+
+        yield frame
+        awaitable = (
+            getattr(awaitable, "cr_await", None)
+            or getattr(awaitable, "gi_yieldfrom", None)
+            or getattr(awaitable, "ag_await", None)
+        )
+
+
+class Profile:
+    """
+    The stacks sampled from one request's task, counted per distinct stack.
+    """
+
+    def __init__(self, task: asyncio.Task[Any], thread_id: int):
+        self.task = task
+        self.thread_id = thread_id
+        self.stacks: Counter[tuple[str, ...]] = Counter()
+
+    def sample(self, thread_frame: Optional[FrameType]) -> None:
+        chain = list(_awaited_frames(self.task.get_coro()))
+        if not chain:
+            return
+
+        stack = [item if isinstance(item, str) else _label(item) for item in chain]
+        innermost = chain[-1]
+        if isinstance(innermost, FrameType):
+            # The task is running, so add the plain function calls made by its
+            # innermost coroutine
+            calls = []
+            frame = thread_frame
+            while frame is not None and frame is not innermost:
+                calls.append(_label(frame))
+                frame = frame.f_back
+            if frame is innermost:
+                stack.extend(reversed(calls))
+
+        self.stacks[tuple(stack)] += 1
+
+    def collapsed(self) -> str:
+        """
+        This function renders the samples in the collapsed stack format read
+        by flamegraph.pl, speedscope and most other flame graph tools.
+        """
+        return "".join(
+            ";".join(frame.replace(";", ":") for frame in stack) + f" {count}\n"
+            for stack, count in self.stacks.items()
+        )
+
+
+class Sampler:
+    """
+    A background thread that samples every active profile on an interval.
+    It only runs while at least one request is being profiled.
+    """
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        self.interval = interval
+        self.profiles: set[Profile] = set()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def add(self, profile: Profile) -> None:
+        with self._lock:
+            self.profiles.add(profile)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="kaede-profiler", daemon=True
+                )
+                self._thread.start()
+
+    def remove(self, profile: Profile) -> None:
+        """
+        This function stops sampling a profile. Sampling passes hold the
+        lock, so the profile is no longer modified once this returns.
+        """
+        with self._lock:
+            self.profiles.discard(profile)
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                if not self.profiles:
+                    self._thread = None
+                    return
+
+                frames = sys._current_frames()
+                for profile in self.profiles:
+                    try:
+                        profile.sample(frames.get(profile.thread_id))
+                    except Exception:
+                        # Frames can be torn down while being walked
+                        logger.debug("Failed to sample a profile", exc_info=True)
+                del frames
+            time.sleep(self.interval)
+
+
+class ProfileStore:
+    """
+    A directory of profiles that keeps only the most recent ones.
+    """
+
+    def __init__(self, directory: Path, keep: int = 100):
+        self.directory = directory
+        self.keep = keep
+
+    def save(self, name: str, profile: Profile) -> Path:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.directory / f"{name}.collapsed"
+        path.write_text(profile.collapsed())
+
+        profiles = sorted(self.directory.glob("*.collapsed"))
+        for old in profiles[: max(0, len(profiles) - self.keep)]:
+            old.unlink(missing_ok=True)
+        return path
+
+
+class ProfilingMiddleware:
+    """
+    Profiles requests that carry the profiling token in the
+    ``X-Kaede-Profile`` header, plus a random sample of all requests.
+
+    A profile samples the stack of the request's task, including while it
+    waits on the database, and is saved in the collapsed stack format. The
+    file name is returned in the ``X-Kaede-Profile-Id`` response header.
+    Requests that are not profiled only pay for a header lookup and a random
+    number.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        *,
+        store: ProfileStore,
+        token: Optional[str] = None,
+        sample_rate: float = 0.0,
+        interval: float = SAMPLE_INTERVAL,
+    ):
+        self.app = app
+        self.store = store
+        self.token = token.encode() if token else None
+        self.sample_rate = sample_rate
+        self.sampler = Sampler(interval)
+
+    def should_profile(self, scope: Scope) -> bool:
+        if self.token is not None:
+            for name, value in scope["headers"]:
+                if name == PROFILE_HEADER:
+                    return hmac.compare_digest(value, self.token)
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or not self.should_profile(scope):
+            return await self.app(scope, receive, send)
+
+        task = asyncio.current_task()
+        assert task is not None
+        # Names sort by time, which the store relies on to drop old profiles
+        now = time.time()
+        name = "{}.{:03d}-{}-{}-{}{}".format(
+            time.strftime("%Y%m%dT%H%M%S", time.gmtime(now)),
+            int(now * 1000) % 1000,
+            os.getpid(),
+            next(_sequence),
+            scope["method"],
+            _UNSAFE.sub("_", scope["path"]),
+        )
+
+        async def send_with_id(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                message["headers"] = [
+                    *message.get("headers", []),
+                    (PROFILE_ID_HEADER, name.encode()),
+                ]
+            await send(message)
+
+        profile = Profile(task, threading.get_ident())
+        started = time.monotonic()
+        self.sampler.add(profile)
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            self.sampler.remove(profile)
+            profiles_captured.inc()
+            path = await asyncio.to_thread(self.store.save, name, profile)
+            logger.info(
+                "Saved a profile of %s %s (%.1f ms, %d samples) to %s",
+                scope["method"],
+                scope["path"],
+                (time.monotonic() - started) * 1000,
+                profile.stacks.total(),
+                path,
+            )
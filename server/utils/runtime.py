@@ -0,0 +1,41 @@
+from __future__ import annotations
+
+import os
+import stat
+import tempfile
+from pathlib import Path
+
+APP_NAME = "kaede"
+
+
+def runtime_dir() -> Path:
+    """
+    This function returns a directory for files shared by the workers of the
+    current user, such as lock files and the shared cache, creating it if
+    needed. It is $XDG_RUNTIME_DIR/kaede when that is set, and a directory in
+    the system temp dir named after the user otherwise.
+
+    The system temp dir is writable by everyone, so the directory is only used
+    if it is a real directory owned by the current user and private to them.
+    """
+    base = os.environ.get("XDG_RUNTIME_DIR")
+    if base:
+        path = Path(base) / APP_NAME
+    else:
+        path = Path(tempfile.gettempdir()) / f"{APP_NAME}-{os.getuid()}"
+
+    try:
+        path.mkdir(mode=0o700)
+    except FileExistsError:
+        pass
+
+    info = os.lstat(path)
+    if (
+        not stat.S_ISDIR(info.st_mode)
+        or info.st_uid != os.getuid()
+        or info.st_mode & (stat.S_IRWXG | stat.S_IRWXO)
+    ):
+        raise RuntimeError(
+            f"{path} must be a directory that only the current user can access"
+        )
+    return path
@@ -1,6 +1,8 @@
 import hashlib
 import hmac
 import secrets
+import struct
+import time
 from datetime import datetime, timedelta
 from typing import Annotated, AsyncGenerator
 
@@ -8,15 +10,34 @@ import db
 from db.models import Session
 from fastapi import Depends, HTTPException
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
-from sqlmodel import select
+from sqlmodel import col, delete, select
 
+from .metrics import metrics
+from .requests import RouteRequest
 from .types import Database
 
 SESSION_EXPIRY = timedelta(days=7)
 SESSION_RENEW_AFTER = timedelta(days=1)
 
+# Sessions are cached across workers for at most this long, and never past
+# the point where they need to be renewed
+SESSION_CACHE_TTL = 60  # seconds
+# The session's user ID
+CACHED_SESSION = struct.Struct("<q")
+
+SWEEP_BATCH_SIZE = 500
+SWEEP_TIME_BUDGET = 0.5  # seconds
+
+sessions_swept = metrics.counter(
+    "kaede_sessions_swept_total", "Expired sessions deleted by the sweeper"
+)
+session_sweeps = metrics.counter(
+    "kaede_session_sweeps_total", "Runs of the expired session sweeper"
+)
+
 
 async def authorize(
+    request: RouteRequest,
     creds: Annotated[HTTPAuthorizationCredentials, Depends(HTTPBearer())],
     db: Annotated[Database, Depends(db.use)],
 ) -> AsyncGenerator[int, None]:
@@ -26,12 +47,18 @@ async def authorize(
     """
 
     authorization = creds.credentials
+    cache = request.app.shared_cache
+    # Tokens are only kept hashed in the cache
+    cache_key = hashlib.sha256(authorization.encode()).digest()
+    if cache is not None and (cached := cache.get("session", cache_key)):
+        (user_id,) = CACHED_SESSION.unpack(cached)
+        yield user_id
+        return
+
     now = datetime.now()
 
     session_query = await db.exec(
-        select(Session).where(
-            Session.token == authorization and Session.expires_at > now
-        )
+        select(Session).where(Session.token == authorization, Session.expires_at > now)
     )
     session = session_query.first()
     if session is None:
@@ -47,6 +74,11 @@ async def authorize(
             await db.commit()
 
     assert session.user_id is not None
+    if cache is not None:
+        renew_at = session.expires_at - SESSION_EXPIRY + SESSION_RENEW_AFTER
+        ttl = min(renew_at.timestamp() - time.time(), SESSION_CACHE_TTL)
+        if ttl > 0:
+            cache.set("session", cache_key, CACHED_SESSION.pack(session.user_id), ttl)
     yield session.user_id
 
 
@@ -91,3 +123,46 @@ def verify_password(password: str, shash: str) -> bool:
         ohash,
         hashlib.pbkdf2_hmac("sha256", password.encode(), osalt, 100000),
     )
+
+
+async def sweep_expired_sessions(
+    db: Database,
+    *,
+    batch_size: int = SWEEP_BATCH_SIZE,
+    time_budget: float = SWEEP_TIME_BUDGET,
+) -> int:
+    """
+    This function deletes expired sessions in batches until none are left or
+    the time budget (in seconds) is spent. Each batch is committed on its own,
+    so the write lock is only ever held for one batch. The number of deleted
+    sessions is returned.
+    """
+    deadline = time.monotonic() + time_budget
+    now = datetime.now()
+    swept = 0
+
+    expired = (
+        select(Session.token)
+        .where(Session.expires_at <= now)
+        .order_by(col(Session.expires_at))
+        .limit(batch_size)
+    )
+    while True:
+        deleted = len(
+            (
+                await db.execute(
+                    delete(Session)
+                    .where(col(Session.token).in_(expired))
+                    .returning(col(Session.token))
+                )
+            ).all()
+        )
+        await db.commit()
+
+        swept += deleted
+        if deleted < batch_size or time.monotonic() >= deadline:
+            break
+
+    session_sweeps.inc()
+    sessions_swept.inc(swept)
+    return swept
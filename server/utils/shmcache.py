@@ -0,0 +1,403 @@
+from __future__ import annotations
+
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import time
+import zlib
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, Optional
+
+from .metrics import metrics
+from .runtime import runtime_dir
+
+# A shared cache is a file mapped into every worker, made of a header, one
+# CLOCK hand per bucket and a fixed number of slots. Keys hash to a bucket of
+# WAYS consecutive slots, and each slot holds a single entry.
+#
+# Writers take an fcntl lock on the bucket's stripe, so workers only contend
+# when writing to the same stripe. Readers take no lock: each slot starts with
+# a sequence number that writers make odd while they modify the slot. A read
+# is only used if the sequence number was even and unchanged around it, and
+# the entry's checksum matches.
+#
+# Every entry is stamped with the cache's generation when written. Bumping the
+# generation invalidates all entries at once, e.g. when a deploy changes what
+# is cached.
+#
+# Entries also carry a version, e.g. when the cached row was last updated.
+# Deleting a key with a version leaves a tombstone of that version, and
+# writing a key is refused while it holds a newer version. A request that read
+# a row just before it was updated therefore cannot cache the old row after
+# the update invalidated it.
+#
+# The layout and size of the cache are part of its file name, so workers with
+# different settings, e.g. during a rolling deploy, map different files. A
+# file mapped by other workers is never resized, which would make their
+# accesses past its new end fail with SIGBUS.
+
+MAGIC = b"KAEDESHM"
+LAYOUT_VERSION = 2
+
+# magic, layout version, slots, slot size, ways, generation, stamp
+HEADER = struct.Struct("<8sIIIIQ32s")
+HEADER_SIZE = 128
+GENERATION_OFFSET = struct.calcsize("<8sIIII")
+
+# seq, generation, key hash, version, expires at, key length, value length,
+# crc, referenced, flags
+SLOT = struct.Struct("<IQQQdHIIBB")
+SEQ = struct.Struct("<I")
+REFERENCED_OFFSET = SLOT.size - 2
+
+TOMBSTONE = 1
+
+WAYS = 8
+STRIPES = 64
+# The lock guarding the generation is taken after the stripe locks
+GENERATION_LOCK = STRIPES
+
+cache_hits = metrics.counter("kaede_shared_cache_hits_total", "Shared cache hits")
+cache_misses = metrics.counter("kaede_shared_cache_misses_total", "Shared cache misses")
+cache_evictions = metrics.counter(
+    "kaede_shared_cache_evictions_total",
+    "Live shared cache entries evicted to make room for new ones",
+)
+
+
+def _hash(key: bytes) -> int:
+    # 0 marks an empty slot
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little") or 1
+
+
+def default_path() -> Path:
+    """
+    This function returns the path of the cache used when none is configured,
+    within the runtime directory of the current user.
+    """
+    return runtime_dir() / "cache"
+
+
+class SharedCache:
+    """
+    A fixed-size key-value cache in shared memory, attached to by every worker.
+
+    Values are opaque bytes, e.g. rendered JSON, and must fit in a slot along
+    with their key. Entries larger than that are not cached.
+    """
+
+    def __init__(
+        self,
+        path: Optional[Path] = None,
+        *,
+        slots: int = 16384,
+        slot_size: int = 1024,
+        stamp: str = "",
+    ):
+        self.ways = WAYS
+        self.buckets = max(1, slots // WAYS)
+        self.slots = self.buckets * WAYS
+        self.slot_size = slot_size
+        path = path or default_path()
+        self.path = path.with_name(
+            f"{path.name}.v{LAYOUT_VERSION}-{self.slots}x{self.slot_size}"
+        )
+        self.capacity = slot_size - SLOT.size
+        self.stamp = hashlib.sha256(stamp.encode()).digest()
+
+        hands_size = -(-self.buckets // 64) * 64
+        self._hands_offset = HEADER_SIZE
+        self._slots_offset = HEADER_SIZE + hands_size
+        self.size = self._slots_offset + self.slots * slot_size
+
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+        try:
+            self._attach()
+        except BaseException:
+            os.close(self._fd)
+            raise
+
+    def _attach(self) -> None:
+        # Serialize attaching, so that only one worker lays out the file
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            size = os.fstat(self._fd).st_size
+            if size == 0:
+                # Just created, and filled with zeros
+                os.ftruncate(self._fd, self.size)
+            elif size != self.size:
+                raise RuntimeError(
+                    f"{self.path} is {size} bytes instead of {self.size}, "
+                    "so it is not a shared cache of this layout"
+                )
+            self._map = mmap.mmap(self._fd, self.size)
+
+            magic, version, slots, slot_size, ways, generation, stamp = (
+                HEADER.unpack_from(self._map, 0)
+            )
+            if magic == bytes(len(MAGIC)):
+                # Not laid out yet
+                generation, stamp = 1, self.stamp
+            elif (magic, version, slots, slot_size, ways) != (
+                MAGIC,
+                LAYOUT_VERSION,
+                self.slots,
+                self.slot_size,
+                self.ways,
+            ):
+                self._map.close()
+                raise RuntimeError(f"{self.path} is not a shared cache of this layout")
+            elif stamp != self.stamp:
+                # Cached by a different version of the app
+                generation, stamp = generation + 1, self.stamp
+
+            HEADER.pack_into(
+                self._map,
+                0,
+                MAGIC,
+                LAYOUT_VERSION,
+                self.slots,
+                self.slot_size,
+                self.ways,
+                generation,
+                stamp,
+            )
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def close(self) -> None:
+        self._map.close()
+        os.close(self._fd)
+
+    @property
+    def generation(self) -> int:
+        return struct.unpack_from("<Q", self._map, GENERATION_OFFSET)[0]
+
+    ### Reading
+
+    def get(self, namespace: str, key: bytes) -> Optional[bytes]:
+        """
+        This function returns the cached value for the key, or None.
+        """
+        value = self._get(f"{namespace}:".encode() + key)
+        if value is None:
+            cache_misses.inc(namespace=namespace)
+        else:
+            cache_hits.inc(namespace=namespace)
+        return value
+
+    def _get(self, key: bytes) -> Optional[bytes]:
+        key_hash = _hash(key)
+        generation = self.generation
+        now = time.time()
+
+        for offset in self._bucket(key_hash):
+            (
+                seq,
+                slot_generation,
+                slot_hash,
+                _,
+                expires_at,
+                key_len,
+                value_len,
+                crc,
+                _,
+                flags,
+            ) = SLOT.unpack_from(self._map, offset)
+            if (
+                slot_hash != key_hash
+                or slot_generation != generation
+                or seq & 1
+                or expires_at <= now
+                or key_len + value_len > self.capacity
+            ):
+                continue
+
+            start = offset + SLOT.size
+            data = self._map[start : start + key_len + value_len]
+            if SEQ.unpack_from(self._map, offset)[0] != seq or zlib.crc32(data) != crc:
+                # Torn by a concurrent write
+                return None
+            if data[:key_len] != key:
+                continue
+            if flags & TOMBSTONE:
+                return None
+
+            self._map[offset + REFERENCED_OFFSET] = 1
+            return data[key_len:]
+        return None
+
+    ### Writing
+
+    def set(
+        self, namespace: str, key: bytes, value: bytes, ttl: float, *, version: int = 0
+    ) -> bool:
+        """
+        This function caches a value of the given version for ttl seconds.
+        Returns whether it was cached, i.e. whether it fits in a slot and the
+        key does not hold a newer version or tombstone.
+        """
+        key = f"{namespace}:".encode() + key
+        if len(key) + len(value) > self.capacity:
+            return False
+        return self._store(key, key + value, ttl, version, 0)
+
+    def delete(
+        self,
+        namespace: str,
+        key: bytes,
+        *,
+        version: Optional[int] = None,
+        ttl: float = 60.0,
+    ) -> None:
+        """
+        This function removes a key. With a version, it leaves a tombstone
+        for ttl seconds, so that the key cannot be set to an older version
+        meanwhile.
+        """
+        key = f"{namespace}:".encode() + key
+        if version is not None:
+            self._store(key, key, ttl, version, TOMBSTONE)
+            return
+
+        key_hash = _hash(key)
+        with self._lock(key_hash % self.buckets % STRIPES):
+            offset = self._find(key_hash, key)
+            if offset is not None:
+                self._write(offset, 0, 0, 0, 0.0, 0, b"", 0)
+
+    def _store(
+        self, key: bytes, data: bytes, ttl: float, version: int, flags: int
+    ) -> bool:
+        key_hash = _hash(key)
+        bucket = key_hash % self.buckets
+        with self._lock(bucket % STRIPES):
+            generation = self.generation
+            offset = self._find(key_hash, key)
+            if offset is None:
+                offset = self._evict(bucket, generation)
+            else:
+                _, slot_generation, _, slot_version, expires_at, *_ = SLOT.unpack_from(
+                    self._map, offset
+                )
+                if (
+                    slot_generation == generation
+                    and expires_at > time.time()
+                    and slot_version > version
+                ):
+                    return False
+
+            self._write(
+                offset,
+                generation,
+                key_hash,
+                version,
+                time.time() + ttl,
+                len(key),
+                data,
+                flags,
+            )
+        return True
+
+    def invalidate(self) -> None:
+        """
+        This function invalidates every entry, in every worker.
+        """
+        with self._lock(GENERATION_LOCK):
+            struct.pack_into("<Q", self._map, GENERATION_OFFSET, self.generation + 1)
+
+    def _find(self, key_hash: int, key: bytes) -> Optional[int]:
+        """
+        This function returns the slot holding the key in any generation.
+        Must be called with the bucket's stripe locked.
+        """
+        for offset in self._bucket(key_hash):
+            _, _, slot_hash, _, _, key_len, *_ = SLOT.unpack_from(self._map, offset)
+            if slot_hash != key_hash:
+                continue
+            start = offset + SLOT.size
+            if self._map[start : start + key_len] == key:
+                return offset
+        return None
+
+    def _evict(self, bucket: int, generation: int) -> int:
+        """
+        This function picks the slot to overwrite within a bucket: a free one
+        if any, and otherwise the next one the CLOCK hand finds unreferenced.
+        Must be called with the bucket's stripe locked.
+        """
+        offsets = list(self._bucket_offsets(bucket))
+        now = time.time()
+        for offset in offsets:
+            _, slot_generation, slot_hash, _, expires_at, *_ = SLOT.unpack_from(
+                self._map, offset
+            )
+            if slot_hash == 0 or slot_generation != generation or expires_at <= now:
+                return offset
+
+        hand = self._hands_offset + bucket
+        position = self._map[hand] % self.ways
+        while True:
+            offset = offsets[position]
+            position = (position + 1) % self.ways
+            if self._map[offset + REFERENCED_OFFSET]:
+                self._map[offset + REFERENCED_OFFSET] = 0
+                continue
+
+            self._map[hand] = position
+            cache_evictions.inc()
+            return offset
+
+    def _write(
+        self,
+        offset: int,
+        generation: int,
+        key_hash: int,
+        version: int,
+        expires_at: float,
+        key_len: int,
+        data: bytes,
+        flags: int,
+    ) -> None:
+        seq = SEQ.unpack_from(self._map, offset)[0]
+        SEQ.pack_into(self._map, offset, (seq + 1) | 1)
+
+        start = offset + SLOT.size
+        self._map[start : start + len(data)] = data
+        SLOT.pack_into(
+            self._map,
+            offset,
+            (seq + 1) | 1,
+            generation,
+            key_hash,
+            version,
+            expires_at,
+            key_len,
+            len(data) - key_len,
+            zlib.crc32(data),
+            0,
+            flags,
+        )
+
+        SEQ.pack_into(self._map, offset, ((seq + 1) | 1) + 1)
+
+    def _bucket(self, key_hash: int) -> Iterator[int]:
+        return self._bucket_offsets(key_hash % self.buckets)
+
+    def _bucket_offsets(self, bucket: int) -> Iterator[int]:
+        first = self._slots_offset + bucket * self.ways * self.slot_size
+        return iter(range(first, first + self.ways * self.slot_size, self.slot_size))
+
+    @contextmanager
+    def _lock(self, stripe: int) -> Iterator[None]:
+        # Record locks are held per process, so this does not exclude other
+        # threads of the same process. Cache writes never yield to the event
+        # loop, so that only matters when called from worker threads.
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, stripe)
+        try:
+            yield
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, stripe)
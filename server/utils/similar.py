@@ -0,0 +1,292 @@
+from __future__ import annotations
+
+import asyncio
+import heapq
+import logging
+import os
+import uuid
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from pathlib import Path
+from typing import Iterable, Optional
+
+import orjson
+from db.models import BookTagChange, BookTags, TableVersion
+from pydantic import BaseModel
+from sqlmodel import col, select
+
+from .types import Database
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 2
+
+# The version of the booktags table, bumped by a trigger on every change, so
+# a snapshot or an index whose watermark matches the table's is up to date.
+Watermark = int
+
+# The number of versions of the booktags table logged in booktagchange. Tag
+# indexes further behind than this are rebuilt instead of caught up.
+BOOK_TAG_CHANGES_KEPT = 10_000
+
+
+class SimilarBook(BaseModel):
+    id: uuid.UUID
+    score: float
+    shared_tags: int
+
+
+class TagIndex:
+    """
+    An in-memory inverted index from tags to the books carrying them.
+
+    Books are numbered with dense ordinals, and each tag maps to a sorted
+    array of ordinals. Finding similar books only touches the posting lists
+    of the query book's tags, instead of joining ``booktags`` with itself.
+    """
+
+    def __init__(self):
+        self.watermark: Optional[Watermark] = None
+        self._books: list[Optional[uuid.UUID]] = []
+        self._ordinals: dict[uuid.UUID, int] = {}
+        self._tags: dict[int, frozenset[int]] = {}
+        self._postings: dict[int, array[int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._ordinals)
+
+    def tags_of(self, book_id: uuid.UUID) -> frozenset[int]:
+        ordinal = self._ordinals.get(book_id)
+        return frozenset() if ordinal is None else self._tags[ordinal]
+
+    def set_tags(self, book_id: uuid.UUID, tag_ids: Iterable[int]) -> None:
+        """
+        This function sets the tags of a book, replacing any previous ones.
+        """
+        self.remove(book_id)
+        tags = frozenset(tag_ids)
+        if not tags:
+            return
+
+        ordinal = len(self._books)
+        self._books.append(book_id)
+        self._ordinals[book_id] = ordinal
+        self._tags[ordinal] = tags
+        for tag in tags:
+            # New ordinals are always the largest, so this keeps the posting
+            # list sorted.
+            self._postings.setdefault(tag, array("I")).append(ordinal)
+
+    def remove(self, book_id: uuid.UUID) -> None:
+        ordinal = self._ordinals.pop(book_id, None)
+        if ordinal is None:
+            return
+
+        self._books[ordinal] = None
+        for tag in self._tags.pop(ordinal):
+            postings = self._postings[tag]
+            del postings[bisect_left(postings, ordinal)]
+            if not postings:
+                del self._postings[tag]
+
+    def similar(self, book_id: uuid.UUID, limit: int = 10) -> list[SimilarBook]:
+        """
+        This function returns the books sharing the most tags with the given
+        book, ranked by the Jaccard similarity of their tag sets.
+        """
+        ordinal = self._ordinals.get(book_id)
+        if ordinal is None:
+            return []
+
+        tags = self._tags[ordinal]
+        overlap: Counter[int] = Counter()
+        for tag in tags:
+            overlap.update(self._postings[tag])
+        del overlap[ordinal]
+
+        size = len(tags)
+        scored = (
+            (shared / (size + len(self._tags[other]) - shared), shared, other)
+            for other, shared in overlap.items()
+        )
+        return [
+            SimilarBook(id=self._books[other], score=score, shared_tags=shared)  # type: ignore
+            for score, shared, other in heapq.nlargest(limit, scored)
+        ]
+
+    def load(self, links: Iterable[tuple[uuid.UUID, int]]) -> None:
+        """
+        This function replaces the index's contents with the given
+        ``(book_id, tag_id)`` links.
+        """
+        books: dict[uuid.UUID, list[int]] = {}
+        for book_id, tag_id in links:
+            books.setdefault(book_id, []).append(tag_id)
+
+        self._books = list(books)
+        self._ordinals = {book_id: ordinal for ordinal, book_id in enumerate(books)}
+        self._tags = {
+            ordinal: frozenset(tags) for ordinal, tags in enumerate(books.values())
+        }
+        postings: dict[int, array[int]] = {}
+        for ordinal, tags in self._tags.items():
+            for tag in tags:
+                postings.setdefault(tag, array("I")).append(ordinal)
+        self._postings = postings
+
+    def advance(self, watermark: Watermark, changes: int) -> None:
+        """
+        This function moves the watermark past a write this worker made to
+        ``booktags`` and already applied to the index, which bumped its
+        version ``changes`` times up to ``watermark``. Unless the index was up
+        to date right before the write, the changes in between are left to
+        refresh().
+        """
+        if self.watermark is not None and self.watermark == watermark - changes:
+            self.watermark = watermark
+
+    ### Persistence
+
+    async def rebuild(self, db: Database) -> None:
+        """
+        This function rebuilds the index from the ``booktags`` table.
+        """
+        watermark = await fetch_watermark(db)
+        links = (
+            await db.exec(
+                select(BookTags.book_id, BookTags.tag_id).execution_options(
+                    allow_full_scan=True
+                )
+            )
+        ).all()
+        await self._load_in_thread(links, watermark)  # type: ignore
+
+    async def refresh(self, db: Database) -> bool:
+        """
+        This function catches the index up with the changes to ``booktags``
+        since its watermark, e.g. by other workers, by reloading the tags of
+        the books logged in ``booktagchange``. The index is rebuilt instead
+        if the log no longer goes back that far. Returns whether it changed.
+        """
+        since = self.watermark
+        watermark = await fetch_watermark(db)
+        if watermark == since:
+            return False
+
+        # Versions are logged without gaps and pruned oldest first, so the log
+        # covers everything since the watermark if it has the next version
+        covered = (
+            since is not None
+            and since < watermark
+            and (
+                await db.exec(
+                    select(BookTagChange.version)
+                    .where(BookTagChange.version == since + 1)
+                    .limit(1)
+                )
+            ).first()
+            is not None
+        )
+        if not covered:
+            await self.rebuild(db)
+            return True
+
+        # Changes made after reading the watermark may show up too. Applying
+        # them early is harmless, as they are applied again next time.
+        changed = (
+            select(BookTagChange.book_id)
+            .where(col(BookTagChange.version) > since)
+            .distinct()
+        )
+        books: dict[uuid.UUID, list[int]] = {
+            book_id: [] for book_id in (await db.exec(changed)).all()
+        }
+        links = await db.exec(
+            select(BookTags.book_id, BookTags.tag_id).where(
+                col(BookTags.book_id).in_(changed)
+            )
+        )
+        for book_id, tag_id in links:
+            books.setdefault(book_id, []).append(tag_id)  # type: ignore
+
+        for book_id, tags in books.items():
+            self.set_tags(book_id, tags)
+        self.watermark = watermark
+        return True
+
+    async def restore(self, db: Database, path: Path) -> None:
+        """
+        This function loads the index from a snapshot if it is still up to
+        date, and otherwise rebuilds it and writes a new snapshot.
+        """
+        watermark = await fetch_watermark(db)
+        try:
+            snapshot = orjson.loads(await asyncio.to_thread(path.read_bytes))
+            if (
+                snapshot["version"] == SNAPSHOT_VERSION
+                and snapshot["watermark"] == watermark
+            ):
+                await self._load_in_thread(
+                    [
+                        (uuid.UUID(hex=book), tag)
+                        for book, tags in snapshot["books"]
+                        for tag in tags
+                    ],
+                    watermark,
+                )
+                return
+        except FileNotFoundError:
+            pass
+        except (orjson.JSONDecodeError, KeyError, TypeError, ValueError):
+            logger.warning("Ignoring invalid tag index snapshot at %s", path)
+
+        await self.rebuild(db)
+        await asyncio.to_thread(self.save, path)
+
+    async def _load_in_thread(
+        self, links: Iterable[tuple[uuid.UUID, int]], watermark: Watermark
+    ) -> None:
+        """
+        This function loads the links into a new index in a thread, so that
+        large indexes do not block the event loop, then swaps it in all at
+        once. Writes this worker applies meanwhile are lost, but the watermark
+        is set back to the loaded one, so the next refresh applies them again.
+        """
+        loaded = TagIndex()
+        await asyncio.to_thread(loaded.load, links)
+        self._books, self._ordinals, self._tags, self._postings = (
+            loaded._books,
+            loaded._ordinals,
+            loaded._tags,
+            loaded._postings,
+        )
+        self.watermark = watermark
+
+    def save(self, path: Path) -> None:
+        """
+        This function atomically writes a snapshot of the index to disk.
+        """
+        if self.watermark is None:
+            return
+
+        snapshot = {
+            "version": SNAPSHOT_VERSION,
+            "watermark": self.watermark,
+            "books": [
+                (book.hex, sorted(self._tags[ordinal]))
+                for book, ordinal in self._ordinals.items()
+            ],
+        }
+        temp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        temp.write_bytes(orjson.dumps(snapshot))
+        os.replace(temp, path)
+
+
+async def fetch_watermark(db: Database) -> Watermark:
+    version = (
+        await db.exec(
+            select(TableVersion.version).where(TableVersion.name == "booktags")
+        )
+    ).first()
+    return version or 0
@@ -0,0 +1,68 @@
+from __future__ import annotations
+
+import resource
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Iterator
+
+
+def _max_rss_kb() -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+@dataclass
+class StartupPhase:
+    name: str
+    started: float
+    duration: float
+    rss_kb: int
+
+
+class StartupTimer:
+    """
+    Records how long each phase of the server's startup takes, along with the
+    peak RSS after each phase.
+    """
+
+    def __init__(self):
+        self.phases: list[StartupPhase] = []
+        self.origin = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append(
+                StartupPhase(
+                    name=name,
+                    started=started - self.origin,
+                    duration=time.perf_counter() - started,
+                    rss_kb=_max_rss_kb(),
+                )
+            )
+
+    def reset(self) -> None:
+        self.phases.clear()
+        self.origin = time.perf_counter()
+
+    def report(self, title: str = "Startup") -> str:
+        """
+        This function renders the recorded phases as a table.
+        """
+        width = max((len(phase.name) for phase in self.phases), default=5)
+        lines = [
+            f"{title} ({time.perf_counter() - self.origin:.3f}s elapsed)",
+            f"{'phase':<{width}}  {'start':>8}  {'took':>8}  {'max rss':>10}",
+        ]
+        for phase in sorted(self.phases, key=lambda phase: phase.started):
+            lines.append(
+                f"{phase.name:<{width}}  {phase.started * 1000:>6.1f}ms  "
+                f"{phase.duration * 1000:>6.1f}ms  {phase.rss_kb / 1024:>8.1f}MB"
+            )
+        return "\n".join(lines)
+
+
+startup = StartupTimer()
@@ -0,0 +1,54 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class PeriodicTask:
+    """
+    Runs a coroutine function in the background on a fixed interval.
+    Failures are logged and do not stop the task.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        interval: float,
+        callback: Callable[[], Awaitable[Any]],
+        *,
+        delay: Optional[float] = None,
+    ):
+        self.name = name
+        self.interval = interval
+        self.callback = callback
+        self.delay = interval if delay is None else delay
+        self._task: Optional[asyncio.Task[None]] = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name=self.name)
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self) -> None:
+        await asyncio.sleep(self.delay)
+        while True:
+            try:
+                await self.callback()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Periodic task %s failed", self.name)
+            await asyncio.sleep(self.interval)